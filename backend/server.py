@@ -1,19 +1,41 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Query, status
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, BulkWriteError, DuplicateKeyError
 import os
+import asyncio
+import time
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 from passlib.context import CryptContext
 import base64
+import hashlib
+import json
 import calendar
+import re
+import zlib
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; without it only gzip is offered
+    brotli = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -28,13 +50,40 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'hubmanager-secret-key-2024-very-secur
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# "session": tokens carry only the user id and every request loads the user.
+# "stateless": tokens carry signed user claims, so requests need no Mongo access;
+# deleted users are rejected through a revocation list refreshed periodically.
+AUTH_MODE = os.environ.get('AUTH_MODE', 'session')
+AUTH_REVOCATION_REFRESH_SECONDS = float(os.environ.get('AUTH_REVOCATION_REFRESH_SECONDS', '30'))
+
+# Authenticated user cache
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '1000'))
+
+# Password hashing. Hashes with a different cost are upgraded on the next login.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# bcrypt is CPU-bound; it runs in a bounded pool so it never blocks the event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_pool_stats = {"in_flight": 0, "completed": 0, "rehashed": 0}
+
+# Login admission control: token buckets per email and per client IP, plus a
+# global cap on concurrent password verifications. Rates are attempts per minute.
+LOGIN_RATE_BACKEND = os.environ.get('LOGIN_RATE_BACKEND', 'memory')  # "memory" or "mongo" (shared across workers)
+LOGIN_EMAIL_BURST = int(os.environ.get('LOGIN_EMAIL_BURST', '5'))  # failed attempts
+LOGIN_EMAIL_PER_MINUTE = float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '5'))
+LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', '30'))
+LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', '60'))
+LOGIN_MAX_CONCURRENT_VERIFICATIONS = int(os.environ.get('LOGIN_MAX_CONCURRENT_VERIFICATIONS', '8'))
+# Reverse proxies in front of the app that append to X-Forwarded-For; 0 ignores the header
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
 
 # Security
 security = HTTPBearer()
 
-app = FastAPI(title="HubManager API")
+app = FastAPI(title="HubManager API", default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
 # ==================== MODELS ====================
@@ -114,6 +163,15 @@ class AttendanceResponse(BaseModel):
     extra_hours: float
     diet: int
 
+# Attendance status codes and the summary counter each one feeds
+ATTENDANCE_STATUS_FIELDS = {
+    "1": "days_worked",
+    "D": "days_rest",
+    "IN": "days_absent",
+    "E": "days_sick",
+    "O": "days_other",
+}
+
 # Vehicle types
 VEHICLE_TYPES = ["Moto", "Furgoneta", "Carrozado", "Trailer", "Camión", "MUS"]
 
@@ -286,6 +344,18 @@ class TimeRestrictionResponse(BaseModel):
     notas: str
     created_at: str
 
+class PlannedDelivery(BaseModel):
+    zona: str
+    plate: str
+    start: str  # "HH:MM"
+    end: str  # "HH:MM"; before start means the window runs past midnight
+    route_id: Optional[str] = None
+    vehicle_class: Optional[str] = None  # overrides the class resolved from the vehicle
+
+class ScheduleValidationRequest(BaseModel):
+    date: str  # YYYY-MM-DD
+    deliveries: List[PlannedDelivery]
+
 # Liquidation models (routes and daily entries)
 class RouteCreate(BaseModel):
     hub_id: str
@@ -326,16 +396,33 @@ class LiquidationEntryResponse(BaseModel):
 
 # ==================== HELPERS ====================
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def run_password_task(fn, *args):
+    password_pool_stats["in_flight"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_pool_stats["in_flight"] -= 1
+        password_pool_stats["completed"] += 1
+
+async def hash_password(password: str) -> str:
+    return await run_password_task(pwd_context.hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> tuple:
+    """Returns (valid, new_hash); new_hash is set when the stored hash uses an outdated cost"""
+    return await run_password_task(pwd_context.verify_and_update, plain_password, hashed_password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def password_pool_metrics() -> dict:
+    return {
+        **password_pool_stats,
+        "workers": PASSWORD_HASH_WORKERS,
+        "queue_depth": max(0, password_pool_stats["in_flight"] - PASSWORD_HASH_WORKERS),
+        "bcrypt_rounds": BCRYPT_ROUNDS
+    }
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    now = datetime.now(timezone.utc)
+    to_encode.update({"iat": now, "exp": now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 def verify_token(token: str) -> dict:
@@ -347,6 +434,119 @@ def verify_token(token: str) -> dict:
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
 
+def user_token_claims(user: dict) -> dict:
+    """Token payload for the configured auth mode"""
+    if AUTH_MODE != "stateless":
+        return {"sub": user["id"]}
+    claims = {
+        "sub": user["id"],
+        "email": user["email"],
+        "full_name": user["full_name"],
+        "is_admin": user.get("is_admin", False),
+        "is_approved": user.get("is_approved", False),
+        "created_at": user["created_at"]
+    }
+    if user.get("hub_ids") is not None:
+        claims["hub_ids"] = user["hub_ids"]
+    return claims
+
+# user_id -> revocation time (epoch seconds); tokens issued before it are rejected
+revoked_users = {}
+_revocation_task = None
+
+async def refresh_revocations():
+    global revoked_users
+    revocations = await db.auth_revocations.find({}, {"_id": 0}).to_list(None)
+    revoked_users = {
+        r["user_id"]: r["revoked_at"].replace(tzinfo=timezone.utc).timestamp() for r in revocations
+    }
+
+async def revocation_refresh_loop():
+    while True:
+        try:
+            await refresh_revocations()
+        except Exception as e:
+            logging.error(f"No se pudo refrescar la lista de revocaciones: {e}")
+        await asyncio.sleep(AUTH_REVOCATION_REFRESH_SECONDS)
+
+async def revoke_user_tokens(user_id: str):
+    """Invalidate every token issued to a user so far"""
+    now = datetime.now(timezone.utc)
+    await db.auth_revocations.update_one({"user_id": user_id}, {"$set": {"revoked_at": now}}, upsert=True)
+    revoked_users[user_id] = now.timestamp()
+    user_cache.invalidate(user_id)
+
+class UserCache:
+    """In-process TTL/LRU cache of user docs for get_current_user.
+    
+    Concurrent misses for the same user share one Mongo lookup.
+    """
+    
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # user_id -> (expires_at, user)
+        self.in_flight = {}  # user_id -> Future
+        self.generation = 0  # bumped on invalidation so in-flight lookups are not stored
+        self.hits = 0
+        self.misses = 0
+    
+    async def get(self, user_id: str) -> Optional[dict]:
+        cached = self.entries.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return cached[1]
+        
+        self.misses += 1
+        while user_id in self.in_flight:
+            future = self.in_flight[user_id]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Only the leader was cancelled, not this request: look the user up again
+                if not future.cancelled():
+                    raise
+        
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[user_id] = future
+        generation = self.generation
+        try:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited future does not log a warning
+            future.exception()
+            raise
+        else:
+            future.set_result(user)
+            if user and generation == self.generation:
+                self.entries[user_id] = (time.monotonic() + self.ttl, user)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            return user
+        finally:
+            # Reached without a result when the leader is cancelled; followers must not wait forever
+            if not future.done():
+                future.cancel()
+            del self.in_flight[user_id]
+    
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+        self.generation += 1
+    
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl
+        }
+
+user_cache = UserCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = verify_token(token)
@@ -354,7 +554,21 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     if not user_id:
         raise HTTPException(status_code=401, detail="Token inválido")
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    # Stateless tokens carry the user claims; no database access needed
+    if AUTH_MODE == "stateless" and "is_admin" in payload:
+        if payload.get("iat", 0) <= revoked_users.get(user_id, -1):
+            raise HTTPException(status_code=401, detail="Sesión revocada")
+        return {
+            "id": user_id,
+            "email": payload.get("email", ""),
+            "full_name": payload.get("full_name", ""),
+            "is_admin": payload["is_admin"],
+            "is_approved": payload.get("is_approved", False),
+            "created_at": payload.get("created_at", ""),
+            "hub_ids": payload.get("hub_ids")
+        }
+    
+    user = await user_cache.get(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="Usuario no encontrado")
     
@@ -365,6 +579,751 @@ async def get_admin_user(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Se requieren permisos de administrador")
     return current_user
 
+def is_valid_date(date_str: str) -> bool:
+    """Check a YYYY-MM-DD date string"""
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def normalize_date(date_str: str) -> Optional[str]:
+    """Convert a DD/MM/YYYY or YYYY-MM-DD date string to YYYY-MM-DD, or None if invalid"""
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime((date_str or "").strip(), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+def validate_bulk_entries(raw_entries: List[Any], model) -> tuple:
+    """Validate each raw bulk entry on its own. Returns ([(index, entry)], errors)"""
+    valid = []
+    errors = []
+    for index, raw in enumerate(raw_entries):
+        try:
+            entry = model.model_validate(raw)
+        except ValidationError as e:
+            errors.extend({
+                "index": index,
+                "field": ".".join(str(loc) for loc in err["loc"]),
+                "error": err["msg"]
+            } for err in e.errors())
+            continue
+        if not is_valid_date(entry.date):
+            errors.append({"index": index, "field": "date", "error": "Fecha inválida, se espera YYYY-MM-DD"})
+            continue
+        valid.append((index, entry))
+    return valid, errors
+
+async def bulk_upsert(collection, operations: List[UpdateOne]) -> tuple:
+    """Run unordered upserts in one round trip. Returns (result counts, {op_index: errmsg})"""
+    if not operations:
+        return {"nMatched": 0, "nUpserted": 0, "nModified": 0, "upserted": []}, {}
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+        return result.bulk_api_result, {}
+    except BulkWriteError as e:
+        details = e.details
+        return details, {err["index"]: err["errmsg"] for err in details.get("writeErrors", [])}
+
+# ==================== PAGINATION ====================
+
+PAGE_MAX_LIMIT = int(os.environ.get('PAGE_MAX_LIMIT', '1000'))
+
+def encode_cursor(doc: dict, sort: List[tuple]) -> str:
+    """Opaque cursor holding the sort key values of the last row of a page"""
+    values = [doc.get(field) for field, _ in sort]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: List[tuple]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+    return values
+
+def keyset_filter(sort: List[tuple], values: list) -> dict:
+    """Rows strictly after values in sort order: (a, b) > (va, vb) as an $or of prefixes.
+    
+    Null and missing values sort before everything else, but $gt/$lt only compare
+    values of the same type, so they are placed explicitly (e.g. incidents whose
+    date could not be parsed have date_iso None and come last in descending order).
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        value = values[i]
+        if direction == ASCENDING:
+            branch[field] = {"$ne": None} if value is None else {"$gt": value}
+        elif value is None:
+            # Nothing sorts below null
+            continue
+        else:
+            branch["$or"] = [{field: {"$lt": value}}, {field: None}]
+        branches.append(branch)
+    return {"$or": branches}
+
+def response_projection(model, sort: List[tuple]) -> dict:
+    """Mongo projection with exactly the fields of a response model, plus the sort keys"""
+    return {"_id": 0, **{field: 1 for field in model.model_fields}, **{field: 1 for field, _ in sort}}
+
+async def paginate(collection, query: dict, sort: List[tuple], row, limit: Optional[int], cursor: Optional[str],
+                   with_total: bool = False, projection: Optional[dict] = None) -> ORJSONResponse:
+    """Keyset pagination over an indexed sort whose last field is unique.
+    
+    Without limit or cursor the whole list is returned as a plain array (the original
+    contract); otherwise {"items", "next_cursor", "total"?}, next_cursor None on the last page.
+    row turns a trusted DB doc into its response dict, so the result is serialized
+    directly instead of being validated again by FastAPI.
+    """
+    projection = projection or {"_id": 0}
+    if limit is None and cursor is None:
+        return ORJSONResponse([row(doc) async for doc in collection.find(query, projection).sort(sort)])
+    
+    limit = min(limit or PAGE_MAX_LIMIT, PAGE_MAX_LIMIT)
+    page_query = {"$and": [query, keyset_filter(sort, decode_cursor(cursor, sort))]} if cursor else query
+    docs = await collection.find(page_query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    page = {
+        "items": [row(doc) for doc in docs],
+        "next_cursor": encode_cursor(docs[-1], sort) if has_more else None
+    }
+    if with_total:
+        # Metadata count for whole collections, an index count otherwise
+        page["total"] = await (collection.estimated_document_count() if not query else collection.count_documents(query))
+    return ORJSONResponse(page)
+
+# ==================== COLUMNAR ENCODING ====================
+
+# format=columnar on month-grid endpoints: ids dictionary-encoded, one array per column
+RESPONSE_FORMATS = ["rows", "columnar"]
+
+def check_response_format(response_format: str, limit: Optional[int] = None, cursor: Optional[str] = None) -> bool:
+    """Validate the format parameter. Returns True for columnar"""
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format debe ser uno de: {RESPONSE_FORMATS}")
+    if response_format == "columnar" and (limit is not None or cursor is not None):
+        raise HTTPException(status_code=400, detail="format=columnar devuelve el mes completo y no admite paginación")
+    return response_format == "columnar"
+
+class DictionaryEncoder:
+    """Maps repeated values to their position in a values list"""
+    
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+    
+    def encode(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+async def columnar_month(collection, query: dict, sort: List[tuple], row, projection: dict,
+                         dictionary_fields: List[str], meta: dict) -> ORJSONResponse:
+    """Rows of a month as column arrays.
+    
+    hub_id is sent once, date becomes the day of month and dictionary_fields hold
+    indexes into "dictionaries"; every other response field is a plain column.
+    """
+    encoders = {field: DictionaryEncoder() for field in dictionary_fields}
+    columns = None
+    async for doc in collection.find(query, projection).sort(sort):
+        values = row(doc)
+        del values["hub_id"]
+        values["day"] = int(values.pop("date")[8:10])
+        if columns is None:
+            columns = {field: [] for field in values}
+        for field, value in values.items():
+            columns[field].append(encoders[field].encode(value) if field in encoders else value)
+    
+    columns = columns or {}
+    return ORJSONResponse({
+        **meta,
+        "format": "columnar",
+        "count": len(columns.get("id", [])),
+        "dictionaries": {field: encoder.values for field, encoder in encoders.items()},
+        "columns": columns
+    })
+
+# ==================== DELTA SYNC ====================
+
+# Hub collections that keep updated_at on every write and accept ?since=<watermark>
+SYNC_COLLECTIONS = ["attendance", "vehicles", "incidents", "purchases", "contacts", "liquidations", "kilos_litros", "records"]
+
+# Deleted ids are remembered this long; an older since must reload the full list
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', '30'))
+# Watermarks trail the clock so a write stamped just before a sync query but
+# committed after it is picked up by the next one
+SYNC_WATERMARK_LAG_SECONDS = float(os.environ.get('SYNC_WATERMARK_LAG_SECONDS', '5'))
+
+# updated_at given to rows written before the field existed
+EPOCH_TIMESTAMP = "1970-01-01T00:00:00.000000+00:00"
+
+def utc_timestamp(at: Optional[datetime] = None) -> str:
+    """Fixed-width UTC ISO timestamp, so updated_at values compare correctly as strings"""
+    return (at or datetime.now(timezone.utc)).astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+def parse_watermark(since: str) -> str:
+    try:
+        at = datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since no válido, se espera una marca de tiempo ISO 8601")
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    if at < datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+        raise HTTPException(status_code=410, detail="since es anterior a la retención de borrados, recarga la lista completa")
+    return utc_timestamp(at)
+
+async def delete_with_tombstones(collection: str, hub_id: str, query: dict, projection: Optional[dict] = None) -> List[dict]:
+    """delete_many that records a tombstone for every row it actually removes. Returns the deleted rows.
+    
+    Rows are deleted by the _id just read, then the query is swept again for rows
+    written in between, until nothing matches.
+    """
+    removed = []
+    while True:
+        batch = await db[collection].find(
+            query, {**(projection or {}), "_id": 1, "id": 1}
+        ).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            return removed
+        await db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        await record_tombstones(collection, hub_id, [doc["id"] for doc in batch if doc.get("id")])
+        removed.extend(batch)
+
+async def record_tombstones(collection: str, hub_id: str, ids: List[str]):
+    """Remember deleted ids so delta sync clients can drop them"""
+    if not ids:
+        return
+    now = datetime.now(timezone.utc)
+    await db.tombstones.insert_many([
+        {"collection": collection, "hub_id": hub_id, "id": doc_id, "updated_at": utc_timestamp(now), "deleted_at": now}
+        for doc_id in ids
+    ], ordered=False)
+
+async def changes_since(collection, query: dict, since: str, row, projection: dict, paged: bool = False) -> ORJSONResponse:
+    """Rows of query written after since plus the ids deleted after it, served by (hub_id, updated_at).
+
+    The client passes the returned watermark as the next since. Rows written
+    close to the watermark may be sent twice; clients upsert them by id.
+    query may only filter on fields a row keeps for life (hub, month of an
+    attendance/liquidation/kilos date, route, vehicle, category): a row updated
+    out of the filter would appear neither in items nor in deleted_ids.
+    """
+    if paged:
+        raise HTTPException(status_code=400, detail="since no admite paginación ni format=columnar")
+    watermark = utc_timestamp(datetime.now(timezone.utc) - timedelta(seconds=SYNC_WATERMARK_LAG_SECONDS))
+    since = parse_watermark(since)
+
+    items = [row(doc) async for doc in collection.find(
+        {**query, "updated_at": {"$gt": since}}, projection
+    ).sort("updated_at", ASCENDING)]
+    deleted_ids = [t["id"] async for t in db.tombstones.find(
+        {"collection": collection.name, "hub_id": query["hub_id"], "updated_at": {"$gt": since}}, {"_id": 0, "id": 1}
+    )]
+    return ORJSONResponse({"items": items, "deleted_ids": deleted_ids, "watermark": watermark})
+
+# ==================== CONDITIONAL GET ====================
+
+# Versions are shared by all server processes through db.resource_versions;
+# other processes see a bump after at most this many seconds
+RESOURCE_VERSION_REFRESH_SECONDS = float(os.environ.get('RESOURCE_VERSION_REFRESH_SECONDS', '5'))
+STATIC_CACHE_SECONDS = int(os.environ.get('STATIC_CACHE_SECONDS', '86400'))
+
+# Hub-scoped data may change at any time: let the client keep it but revalidate on every use
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+# (collection, hub_id) -> version, bumped by every write to that hub's rows
+resource_versions: Dict[tuple, int] = {}
+_resource_version_task = None
+
+async def bump_version(collection: str, hub_id: str):
+    """Record a write so ETags issued for the hub's collection stop matching"""
+    doc = await db.resource_versions.find_one_and_update(
+        {"collection": collection, "hub_id": hub_id},
+        {"$inc": {"version": 1}},
+        projection={"_id": 0, "version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    key = (collection, hub_id)
+    resource_versions[key] = max(resource_versions.get(key, 0), doc["version"])
+
+async def refresh_resource_versions():
+    async for doc in db.resource_versions.find({}, {"_id": 0}):
+        key = (doc["collection"], doc["hub_id"])
+        resource_versions[key] = max(resource_versions.get(key, 0), doc["version"])
+
+async def resource_version_refresh_loop():
+    while True:
+        await asyncio.sleep(RESOURCE_VERSION_REFRESH_SECONDS)
+        try:
+            await refresh_resource_versions()
+        except Exception as e:
+            logging.error(f"No se pudieron refrescar las versiones de recursos: {e}")
+
+def content_hash(content) -> str:
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+
+def resource_etag(hub_id: str, *collections: str, suffix: str = "") -> str:
+    """Strong ETag from the current versions of the collections a response is built from"""
+    parts = [f"{c}.{resource_versions.get((c, hub_id), 0)}" for c in collections]
+    if suffix:
+        parts.append(suffix)
+    return '"' + "-".join(parts) + '"'
+
+def static_etag(content) -> str:
+    return f'"{content_hash(content)}"'
+
+# Content-codings the compression middleware appends to the ETag of an encoded body
+ETAG_ENCODINGS = ("gzip", "br")
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """Strong ETag of the encoded representation: a strong validator changes with the content-coding"""
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else etag
+
+def decoded_etag(etag: str) -> str:
+    for encoding in ETAG_ENCODINGS:
+        if etag.endswith(f'-{encoding}"'):
+            return etag[:-len(encoding) - 2] + '"'
+    return etag
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match uses weak comparison; any encoding of the same content matches
+    candidates = [decoded_etag(tag.strip().removeprefix("W/")) for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+def not_modified(etag: str, cache_control: str = REVALIDATE_CACHE_CONTROL) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+def cacheable(content, etag: str, cache_control: str = REVALIDATE_CACHE_CONTROL) -> ORJSONResponse:
+    return ORJSONResponse(content, headers={"ETag": etag, "Cache-Control": cache_control})
+
+# ==================== LOGIN ADMISSION ====================
+
+class MemoryTokenBucketStore:
+    """Token buckets kept in this process"""
+    
+    MAX_BUCKETS = 10000
+    
+    def __init__(self):
+        self.buckets = {}  # key -> (tokens, updated_at, capacity, per_second)
+    
+    def refill(self, key: str, capacity: int, per_second: float) -> float:
+        now = time.monotonic()
+        tokens, updated_at, _, _ = self.buckets.get(key, (capacity, now, capacity, per_second))
+        return min(capacity, tokens + (now - updated_at) * per_second)
+    
+    async def peek(self, key: str, capacity: int, per_second: float) -> tuple:
+        """Check for a token without taking it. Returns (allowed, seconds until a token is available)"""
+        tokens = self.refill(key, capacity, per_second)
+        return tokens >= 1, 0 if tokens >= 1 else math.ceil((1 - tokens) / per_second)
+    
+    async def take(self, key: str, capacity: int, per_second: float) -> tuple:
+        """Take one token. Returns (allowed, seconds until a token is available)"""
+        tokens = self.refill(key, capacity, per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, time.monotonic(), capacity, per_second)
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.prune()
+        return allowed, 0 if allowed else math.ceil((1 - tokens) / per_second)
+    
+    def prune(self):
+        # Buckets that have refilled completely carry no state
+        now = time.monotonic()
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]
+        }
+
+class MongoTokenBucketStore:
+    """Token buckets shared by every worker, updated atomically in Mongo"""
+    
+    async def peek(self, key: str, capacity: int, per_second: float) -> tuple:
+        bucket = await db.login_rate_limits.find_one({"key": key}, {"_id": 0})
+        if not bucket:
+            return True, 0
+        elapsed = (datetime.now(timezone.utc) - bucket["updated_at"].replace(tzinfo=timezone.utc)).total_seconds()
+        tokens = min(capacity, bucket["tokens"] + elapsed * per_second)
+        return tokens >= 1, 0 if tokens >= 1 else math.ceil((1 - tokens) / per_second)
+    
+    async def take(self, key: str, capacity: int, per_second: float) -> tuple:
+        now = datetime.now(timezone.utc)
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        bucket = await db.login_rate_limits.find_one_and_update(
+            {"key": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [{"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, per_second]}]}]},
+                    "updated_at": now
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket["allowed"]:
+            return True, 0
+        return False, math.ceil((1 - bucket["tokens"]) / per_second)
+
+login_rate_store = MongoTokenBucketStore() if LOGIN_RATE_BACKEND == "mongo" else MemoryTokenBucketStore()
+login_admission_stats = {"verifying": 0, "admitted": 0, "rejected_rate": 0, "rejected_busy": 0}
+
+def client_ip(request: Request) -> str:
+    # Hops left of the ones our proxies appended are sent by the client and can be forged,
+    # so the client is the hop added by the outermost trusted proxy
+    forwarded = request.headers.get("x-forwarded-for")
+    if TRUSTED_PROXY_COUNT > 0 and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+def too_many_requests(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Demasiados intentos de inicio de sesión. Inténtalo más tarde.",
+        headers={"Retry-After": str(max(1, retry_after))}
+    )
+
+def login_buckets(request: Request, email: str) -> dict:
+    return {
+        "email": (f"email:{email.lower()}", LOGIN_EMAIL_BURST, LOGIN_EMAIL_PER_MINUTE / 60),
+        "ip": (f"ip:{client_ip(request)}", LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE / 60),
+    }
+
+async def admit_login(request: Request, email: str):
+    """Raise 429 if this login attempt exceeds its IP budget or the email has too many recent failures"""
+    buckets = login_buckets(request, email)
+    # Every attempt costs an IP token; email tokens are only spent by failed attempts
+    for check, (key, capacity, per_second) in (("take", buckets["ip"]), ("peek", buckets["email"])):
+        allowed, retry_after = await getattr(login_rate_store, check)(key, capacity, per_second)
+        if not allowed:
+            login_admission_stats["rejected_rate"] += 1
+            raise too_many_requests(retry_after)
+
+async def record_login_failure(request: Request, email: str):
+    await login_rate_store.take(*login_buckets(request, email)["email"])
+
+async def verify_login_password(plain_password: str, hashed_password: str) -> tuple:
+    """verify_password behind the global cap on concurrent verifications"""
+    if login_admission_stats["verifying"] >= LOGIN_MAX_CONCURRENT_VERIFICATIONS:
+        login_admission_stats["rejected_busy"] += 1
+        raise too_many_requests(1)
+    login_admission_stats["verifying"] += 1
+    login_admission_stats["admitted"] += 1
+    try:
+        return await verify_password(plain_password, hashed_password)
+    finally:
+        login_admission_stats["verifying"] -= 1
+
+# ==================== INDEXES ====================
+
+# Compound indexes matching the query shapes used by the endpoints below.
+# Each entry: (collection, keys, options). Names are explicit so option changes
+# can be detected and the index rebuilt.
+INDEX_SPECS = [
+    ("users", [("id", ASCENDING)], {"name": "users_id", "unique": True}),
+    ("users", [("email", ASCENDING)], {"name": "users_email", "unique": True}),
+    ("users", [("is_approved", ASCENDING)], {"name": "users_is_approved"}),
+    ("users", [("created_at", ASCENDING), ("id", ASCENDING)], {"name": "users_created"}),
+    ("hubs", [("id", ASCENDING)], {"name": "hubs_id", "unique": True}),
+    ("hubs", [("name", ASCENDING)], {"name": "hubs_name"}),
+    ("employees", [("hub_id", ASCENDING), ("id", ASCENDING)], {"name": "employees_hub_id"}),
+    ("employees", [("id", ASCENDING)], {"name": "employees_id"}),
+    ("attendance", [("hub_id", ASCENDING), ("date", ASCENDING)], {"name": "attendance_hub_date"}),
+    ("attendance", [("employee_id", ASCENDING), ("hub_id", ASCENDING), ("date", ASCENDING)], {"name": "attendance_employee_hub_date", "unique": True}),
+    ("vehicles", [("hub_id", ASCENDING), ("id", ASCENDING)], {"name": "vehicles_hub_id"}),
+    ("vehicles", [("id", ASCENDING)], {"name": "vehicles_id"}),
+    ("vehicles", [("plate", ASCENDING)], {"name": "vehicles_plate"}),
+    ("incidents", [("hub_id", ASCENDING), ("date_iso", DESCENDING), ("id", DESCENDING)], {"name": "incidents_hub_date"}),
+    ("incidents", [("hub_id", ASCENDING), ("vehicle_id", ASCENDING), ("date_iso", DESCENDING), ("id", DESCENDING)],
+     {"name": "incidents_hub_vehicle_date"}),
+    ("incidents", [("vehicle_id", ASCENDING)], {"name": "incidents_vehicle_id"}),
+    ("incidents", [("id", ASCENDING)], {"name": "incidents_id"}),
+    ("purchases", [("hub_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], {"name": "purchases_hub_created"}),
+    ("purchases", [("id", ASCENDING)], {"name": "purchases_id"}),
+    ("contacts", [("hub_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], {"name": "contacts_hub_created"}),
+    ("contacts", [("id", ASCENDING)], {"name": "contacts_id"}),
+    ("routes", [("hub_id", ASCENDING), ("name", ASCENDING)], {"name": "routes_hub_name"}),
+    ("routes", [("id", ASCENDING), ("hub_id", ASCENDING)], {"name": "routes_id_hub"}),
+    ("liquidations", [("hub_id", ASCENDING), ("date", ASCENDING), ("id", ASCENDING)], {"name": "liquidations_hub_date"}),
+    ("liquidations", [("route_id", ASCENDING), ("date", ASCENDING)], {"name": "liquidations_route_date", "unique": True}),
+    ("liquidations", [("id", ASCENDING)], {"name": "liquidations_id"}),
+    ("kilos_litros", [("hub_id", ASCENDING), ("date", ASCENDING), ("id", ASCENDING)], {"name": "kilos_litros_hub_date"}),
+    ("kilos_litros", [("route_id", ASCENDING), ("date", ASCENDING), ("repartidor", ASCENDING)], {"name": "kilos_litros_route_date_repartidor", "unique": True}),
+    ("kilos_litros", [("id", ASCENDING)], {"name": "kilos_litros_id"}),
+    ("liquidation_ledger", [("repartidor", ASCENDING), ("year", ASCENDING), ("month", ASCENDING), ("hub_id", ASCENDING)],
+     {"name": "liquidation_ledger_key", "unique": True}),
+    ("liquidation_ledger", [("year", ASCENDING), ("month", ASCENDING)], {"name": "liquidation_ledger_period"}),
+    ("liquidation_balances", [("repartidor", ASCENDING)], {"name": "liquidation_balances_repartidor", "unique": True}),
+    ("resource_versions", [("collection", ASCENDING), ("hub_id", ASCENDING)], {"name": "resource_versions_key", "unique": True}),
+    ("auth_revocations", [("user_id", ASCENDING)], {"name": "auth_revocations_user_id", "unique": True}),
+    ("auth_revocations", [("revoked_at", ASCENDING)],
+     {"name": "auth_revocations_ttl", "expireAfterSeconds": ACCESS_TOKEN_EXPIRE_MINUTES * 60}),
+    ("login_rate_limits", [("key", ASCENDING)], {"name": "login_rate_limits_key", "unique": True}),
+    ("login_rate_limits", [("updated_at", ASCENDING)], {"name": "login_rate_limits_ttl", "expireAfterSeconds": 3600}),
+    ("kilos_litros_rollups", [(field, ASCENDING) for field in ["hub_id", "year", "month", "route_id", "repartidor"]],
+     {"name": "kilos_litros_rollups_key", "unique": True}),
+    ("holidays", [("hub_id", ASCENDING), ("date", ASCENDING)], {"name": "holidays_hub_date"}),
+    ("time_restrictions", [("hub_id", ASCENDING), ("id", ASCENDING)], {"name": "time_restrictions_hub_id"}),
+    ("records", [("hub_id", ASCENDING), ("category", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)],
+     {"name": "records_hub_category"}),
+    ("records", [("hub_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], {"name": "records_hub_created"}),
+    ("records", [("id", ASCENDING)], {"name": "records_id"}),
+    *[(c, [("hub_id", ASCENDING), ("updated_at", ASCENDING)], {"name": f"{c}_hub_updated"}) for c in SYNC_COLLECTIONS],
+    ("tombstones", [("collection", ASCENDING), ("hub_id", ASCENDING), ("updated_at", ASCENDING)], {"name": "tombstones_key"}),
+    ("tombstones", [("deleted_at", ASCENDING)],
+     {"name": "tombstones_ttl", "expireAfterSeconds": TOMBSTONE_RETENTION_DAYS * 86400}),
+]
+
+# Keyset sort orders of the paginated lists; the last field is unique
+USERS_SORT = [("created_at", ASCENDING), ("id", ASCENDING)]
+INCIDENTS_SORT = [("date_iso", DESCENDING), ("id", DESCENDING)]
+CREATED_SORT = [("created_at", ASCENDING), ("id", ASCENDING)]
+DATE_SORT = [("date", ASCENDING), ("id", ASCENDING)]
+
+# Representative query per endpoint, used by the explain-plan audit.
+# Values are placeholders: only the query shape matters for plan selection.
+AUDITED_QUERIES = [
+    {"endpoint": "POST /auth/login", "collection": "users", "filter": {"email": "audit@example.com"}},
+    {"endpoint": "get_current_user", "collection": "users", "filter": {"id": "audit"}},
+    {"endpoint": "GET /admin/users/pending", "collection": "users", "filter": {"is_approved": False}},
+    {"endpoint": "GET /admin/users", "collection": "users", "filter": {}, "sort": USERS_SORT},
+    {"endpoint": "GET /hubs/{hub_id}", "collection": "hubs", "filter": {"id": "audit"}},
+    {"endpoint": "GET /hubs/{hub_id}/employees", "collection": "employees", "filter": {"hub_id": "audit"}},
+    {"endpoint": "GET /hubs/{hub_id}/attendance", "collection": "attendance",
+     "filter": {"hub_id": "audit", "date": {"$gte": "2026-01-01", "$lte": "2026-01-31"}}},
+    {"endpoint": "POST /hubs/{hub_id}/attendance", "collection": "attendance",
+     "filter": {"employee_id": "audit", "hub_id": "audit", "date": "2026-01-01"}},
+    {"endpoint": "GET /hubs/{hub_id}/vehicles", "collection": "vehicles", "filter": {"hub_id": "audit"}},
+    {"endpoint": "POST /hubs/{hub_id}/vehicles", "collection": "vehicles", "filter": {"plate": "AUDIT"}},
+    {"endpoint": "GET /hubs/{hub_id}/incidents", "collection": "incidents",
+     "filter": {"hub_id": "audit", "date_iso": {"$gte": "2026-01-01", "$lte": "2026-12-31"}},
+     "sort": INCIDENTS_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/incidents?vehicle_id", "collection": "incidents",
+     "filter": {"hub_id": "audit", "vehicle_id": "audit"}, "sort": INCIDENTS_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/incidents/summary", "collection": "incidents",
+     "filter": {"hub_id": "audit", "vehicle_id": {"$in": ["audit", "audit2"]}}},
+    {"endpoint": "GET /hubs/{hub_id}/purchases", "collection": "purchases", "filter": {"hub_id": "audit"}, "sort": CREATED_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/contacts", "collection": "contacts", "filter": {"hub_id": "audit"}, "sort": CREATED_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/routes", "collection": "routes",
+     "filter": {"hub_id": "audit"}, "sort": [("name", ASCENDING)]},
+    {"endpoint": "GET /hubs/{hub_id}/liquidations", "collection": "liquidations",
+     "filter": {"hub_id": "audit", "date": {"$gte": "2026-01-01", "$lte": "2026-01-31"}}, "sort": DATE_SORT},
+    {"endpoint": "POST /hubs/{hub_id}/liquidations", "collection": "liquidations",
+     "filter": {"route_id": "audit", "date": "2026-01-01"}},
+    {"endpoint": "GET /hubs/{hub_id}/kilos-litros", "collection": "kilos_litros",
+     "filter": {"hub_id": "audit", "date": {"$gte": "2026-01-01", "$lte": "2026-01-31"}}, "sort": DATE_SORT},
+    {"endpoint": "POST /hubs/{hub_id}/kilos-litros", "collection": "kilos_litros",
+     "filter": {"route_id": "audit", "date": "2026-01-01", "repartidor": "audit"}},
+    {"endpoint": "GET /hubs/{hub_id}/holidays", "collection": "holidays",
+     "filter": {"hub_id": "audit", "date": {"$gte": "2026-01-01", "$lte": "2026-12-31"}}},
+    {"endpoint": "GET /hubs/{hub_id}/time-restrictions", "collection": "time_restrictions", "filter": {"hub_id": "audit"}},
+    {"endpoint": "GET /hubs/{hub_id}/records", "collection": "records", "filter": {"hub_id": "audit"}, "sort": CREATED_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/records?category", "collection": "records",
+     "filter": {"hub_id": "audit", "category": "audit"}, "sort": CREATED_SORT},
+    {"endpoint": "GET /hubs/{hub_id}/liquidations?since", "collection": "liquidations",
+     "filter": {"hub_id": "audit", "date": {"$gte": "2026-01-01", "$lte": "2026-01-31"}, "updated_at": {"$gt": EPOCH_TIMESTAMP}},
+     "sort": [("updated_at", ASCENDING)]},
+    {"endpoint": "GET /hubs/{hub_id}/contacts?since", "collection": "contacts",
+     "filter": {"hub_id": "audit", "updated_at": {"$gt": EPOCH_TIMESTAMP}}, "sort": [("updated_at", ASCENDING)]},
+    {"endpoint": "GET /hubs/{hub_id}/contacts?since (deleted)", "collection": "tombstones",
+     "filter": {"collection": "contacts", "hub_id": "audit", "updated_at": {"$gt": EPOCH_TIMESTAMP}}},
+]
+
+# Index build state, reported by the audit endpoint
+index_build_status = {"state": "pending", "created": [], "errors": []}
+_index_build_task = None
+
+# Server error codes raised when an index with the same name exists with other options
+INDEX_CONFLICT_CODES = (85, 86)
+DUPLICATE_KEY_CODE = 11000
+
+# Collections whose unique natural key may already be duplicated by concurrent pastes
+# written before the unique index existed. A failed build only reports them;
+# POST /admin/indexes/dedupe removes them.
+DEDUPE_COLLECTIONS = {"attendance", "liquidations", "kilos_litros"}
+
+def duplicate_keys_pipeline(fields: List[str]) -> list:
+    """Groups of rows sharing the natural key, oldest row first"""
+    return [
+        {"$sort": {"_id": 1}},
+        {"$group": {
+            "_id": {field: f"${field}" for field in fields},
+            "rows": {"$push": {"_id": "$_id", "id": "$id", "hub_id": "$hub_id"}},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+
+async def count_duplicate_keys(collection: str, fields: List[str]) -> int:
+    pipeline = [*duplicate_keys_pipeline(fields)[1:], {"$count": "keys"}]
+    result = await db[collection].aggregate(pipeline, allowDiskUse=True).to_list(1)
+    return result[0]["keys"] if result else 0
+
+async def dedupe_natural_key(collection: str, fields: List[str]) -> int:
+    """Keep the oldest row of each duplicated key and delete the others. Returns rows deleted.
+    
+    Before the unique index, saves updated the first row find_one returned, i.e. the
+    oldest one, so that row holds the live values and the later copies are stale.
+    """
+    removed = []
+    async for group in db[collection].aggregate(duplicate_keys_pipeline(fields), allowDiskUse=True):
+        removed.extend(group["rows"][1:])
+    if not removed:
+        return 0
+    
+    await db[collection].delete_many({"_id": {"$in": [row["_id"] for row in removed]}})
+    by_hub = {}
+    for row in removed:
+        if row.get("id"):
+            by_hub.setdefault(row.get("hub_id"), []).append(row["id"])
+    for hub_id, ids in by_hub.items():
+        await record_tombstones(collection, hub_id, ids)
+    
+    # The derived totals still count the deleted rows
+    if collection == "liquidations":
+        await rebuild_liquidation_ledger()
+    elif collection == "kilos_litros":
+        await rebuild_kilos_litros_rollups()
+    logging.warning(f"Eliminados {len(removed)} duplicados de {collection} por {fields}")
+    return len(removed)
+
+async def ensure_indexes():
+    """Create every index in INDEX_SPECS. Safe to run repeatedly."""
+    index_build_status.update({"state": "running", "created": [], "errors": []})
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            try:
+                name = await db[collection].create_index(keys, background=True, **options)
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                # Spec changed (e.g. became unique): rebuild under the same name
+                previous = (await db[collection].index_information()).get(options["name"])
+                await db[collection].drop_index(options["name"])
+                try:
+                    name = await db[collection].create_index(keys, background=True, **options)
+                except Exception:
+                    # Put the old index back so its queries do not fall back to a collection scan
+                    if previous:
+                        restored = {k: v for k, v in previous.items() if k not in ("key", "v", "ns")}
+                        await db[collection].create_index(previous["key"], name=options["name"], **restored)
+                    raise
+            index_build_status["created"].append(f"{collection}.{name}")
+        except Exception as e:
+            logging.error(f"No se pudo crear el índice {collection}.{options['name']}: {e}")
+            error = {
+                "collection": collection,
+                "index": options["name"],
+                "error": str(e)
+            }
+            if isinstance(e, OperationFailure) and e.code == DUPLICATE_KEY_CODE and collection in DEDUPE_COLLECTIONS:
+                try:
+                    error["duplicate_keys"] = await count_duplicate_keys(collection, [field for field, _ in keys])
+                except Exception as count_error:
+                    logging.error(f"No se pudieron contar los duplicados de {collection}: {count_error}")
+            index_build_status["errors"].append(error)
+    index_build_status["state"] = "done"
+    logging.info(f"Índices verificados: {len(index_build_status['created'])} ok, {len(index_build_status['errors'])} errores")
+
+def plan_stages(plan: dict) -> List[str]:
+    """Flatten the stage names of an explain() plan tree"""
+    if not plan:
+        return []
+    # Slot-based engine wraps the classic tree in "queryPlan"
+    if "queryPlan" in plan:
+        plan = plan["queryPlan"]
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages.extend(plan_stages(plan["inputStage"]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+# ==================== MIGRATIONS ====================
+
+MIGRATION_BATCH_SIZE = 500
+_migration_task = None
+_sync_migration_task = None
+
+async def migrate_incident_dates(batch_size: int = MIGRATION_BATCH_SIZE):
+    """Backfill incidents.date_iso in batches. Resumable: each batch starts after the last saved _id."""
+    name = "incident_date_iso"
+    migration = await db.migrations.find_one({"name": name}, {"_id": 0, "state": 1, "last_id": 1})
+    # An interrupted run continues where it stopped; a finished one is re-run from the start
+    last_id = migration.get("last_id") if migration and migration.get("state") == "running" else None
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "running", "started_at": datetime.now(timezone.utc).isoformat()},
+         "$setOnInsert": {"processed": 0, "invalid": 0}},
+        upsert=True
+    )
+    while True:
+        query = {"date_iso": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db.incidents.find(query, {"_id": 1, "date": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        
+        # Unparseable dates are stored as None so they are not picked up again
+        normalized = [(i["_id"], normalize_date(i.get("date", ""))) for i in batch]
+        await db.incidents.bulk_write(
+            [UpdateOne({"_id": _id}, {"$set": {"date_iso": date_iso}}) for _id, date_iso in normalized],
+            ordered=False
+        )
+        await db.migrations.update_one(
+            {"name": name},
+            {
+                "$inc": {"processed": len(batch), "invalid": sum(1 for _, d in normalized if d is None)},
+                "$set": {"last_id": last_id}
+            }
+        )
+    
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "done", "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    logging.info("Migración de fechas de incidencias completada")
+
+async def migrate_updated_at():
+    """Give rows written before delta sync an updated_at, so the (hub_id, updated_at) indexes cover them"""
+    name = "sync_updated_at"
+    migration = await db.migrations.find_one({"name": name}, {"_id": 0, "state": 1})
+    if migration and migration.get("state") == "done":
+        return
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "running", "started_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    processed = 0
+    for collection in SYNC_COLLECTIONS:
+        result = await db[collection].update_many(
+            {"updated_at": {"$exists": False}}, {"$set": {"updated_at": EPOCH_TIMESTAMP}}
+        )
+        processed += result.modified_count
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "done", "processed": processed, "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    logging.info(f"Migración de updated_at completada: {processed} filas")
+
 # ==================== STARTUP ====================
 
 @app.on_event("startup")
@@ -377,7 +1336,7 @@ async def startup_event():
         admin_user = {
             "id": str(uuid.uuid4()),
             "email": admin_email,
-            "password": hash_password("admin123"),
+            "password": await hash_password("admin123"),
             "full_name": "Administrador",
             "is_admin": True,
             "is_approved": True,
@@ -402,11 +1361,38 @@ async def startup_event():
             hub = {
                 "id": str(uuid.uuid4()),
                 **hub_data,
+                "location_key": get_location_key(f"{hub_data['location']} {hub_data['name']}"),
                 "created_at": datetime.now(timezone.utc).isoformat()
             }
             await db.hubs.insert_one(hub)
     
     logging.info("Hubs por defecto creados")
+    
+    # Build indexes in the background so startup is not blocked on large collections
+    global _index_build_task
+    _index_build_task = asyncio.create_task(ensure_indexes())
+    
+    # Backfill the canonical incident date for rows written before it existed
+    global _migration_task
+    _migration_task = asyncio.create_task(migrate_incident_dates())
+    
+    global _sync_migration_task
+    _sync_migration_task = asyncio.create_task(migrate_updated_at())
+    
+    global _rollup_task
+    _rollup_task = asyncio.create_task(ensure_kilos_litros_rollups())
+    
+    global _ledger_task
+    _ledger_task = asyncio.create_task(ensure_liquidation_ledger())
+    
+    global _revocation_task
+    if AUTH_MODE == "stateless":
+        _revocation_task = asyncio.create_task(revocation_refresh_loop())
+    
+    # Load versions before serving so ETags issued before a restart stay valid
+    global _resource_version_task
+    await refresh_resource_versions()
+    _resource_version_task = asyncio.create_task(resource_version_refresh_loop())
 
 # ==================== AUTH ROUTES ====================
 
@@ -419,7 +1405,7 @@ async def register(user_data: UserCreate):
     user = {
         "id": str(uuid.uuid4()),
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password(user_data.password),
         "full_name": user_data.full_name,
         "is_admin": False,
         "is_approved": False,
@@ -434,19 +1420,29 @@ async def register(user_data: UserCreate):
     }
 
 @api_router.post("/auth/login", response_model=TokenResponse)
-async def login(login_data: UserLogin):
+async def login(login_data: UserLogin, request: Request):
+    await admit_login(request, login_data.email)
+    
     user = await db.users.find_one({"email": login_data.email}, {"_id": 0})
     
     if not user:
+        await record_login_failure(request, login_data.email)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
-    if not verify_password(login_data.password, user["password"]):
+    valid, new_hash = await verify_login_password(login_data.password, user["password"])
+    if not valid:
+        await record_login_failure(request, login_data.email)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
+    if new_hash:
+        # Cost factor changed since this hash was created
+        await db.users.update_one({"id": user["id"]}, {"$set": {"password": new_hash}})
+        password_pool_stats["rehashed"] += 1
+    
     if not user.get("is_approved"):
         raise HTTPException(status_code=403, detail="Tu cuenta está pendiente de aprobación")
     
-    access_token = create_access_token({"sub": user["id"]})
+    access_token = create_access_token(user_token_claims(user))
     
     return TokenResponse(
         access_token=access_token,
@@ -485,17 +1481,27 @@ async def get_pending_users(admin: dict = Depends(get_admin_user)):
         created_at=u["created_at"]
     ) for u in users]
 
-@api_router.get("/admin/users", response_model=List[UserResponse])
-async def get_all_users(admin: dict = Depends(get_admin_user)):
-    users = await db.users.find({}, {"_id": 0, "password": 0}).to_list(100)
-    return [UserResponse(
-        id=u["id"],
-        email=u["email"],
-        full_name=u["full_name"],
-        is_admin=u.get("is_admin", False),
-        is_approved=u.get("is_approved", False),
-        created_at=u["created_at"]
-    ) for u in users]
+USER_LIST_PROJECTION = response_projection(UserResponse, USERS_SORT)
+
+def user_row(u: dict) -> dict:
+    """UserResponse fields of a trusted users doc"""
+    return {
+        "id": u["id"],
+        "email": u["email"],
+        "full_name": u["full_name"],
+        "is_admin": bool(u.get("is_admin", False)),
+        "is_approved": bool(u.get("is_approved", False)),
+        "created_at": u["created_at"]
+    }
+
+@api_router.get("/admin/users")
+async def get_all_users(
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    admin: dict = Depends(get_admin_user)
+):
+    return await paginate(db.users, {}, USERS_SORT, user_row, limit, cursor, total, USER_LIST_PROJECTION)
 
 @api_router.post("/admin/users/{user_id}/approve")
 async def approve_user(user_id: str, admin: dict = Depends(get_admin_user)):
@@ -505,6 +1511,7 @@ async def approve_user(user_id: str, admin: dict = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    user_cache.invalidate(user_id)
     return {"message": "Usuario aprobado correctamente"}
 
 @api_router.post("/admin/users/{user_id}/reject")
@@ -512,6 +1519,7 @@ async def reject_user(user_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    await revoke_user_tokens(user_id)
     return {"message": "Usuario rechazado y eliminado"}
 
 @api_router.delete("/admin/users/{user_id}")
@@ -519,8 +1527,88 @@ async def delete_user(user_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    await revoke_user_tokens(user_id)
     return {"message": "Usuario eliminado correctamente"}
 
+@api_router.get("/admin/metrics")
+async def get_metrics(admin: dict = Depends(get_admin_user)):
+    return {
+        "user_cache": user_cache.stats(),
+        "password_hashing": password_pool_metrics(),
+        "login_admission": {
+            **login_admission_stats,
+            "max_concurrent_verifications": LOGIN_MAX_CONCURRENT_VERIFICATIONS,
+            "backend": LOGIN_RATE_BACKEND
+        },
+        "compression": compression_metrics()
+    }
+
+@api_router.get("/admin/indexes/audit")
+async def audit_indexes(admin: dict = Depends(get_admin_user)):
+    """Run explain() for every audited endpoint query and report collection scans"""
+    queries = []
+    for q in AUDITED_QUERIES:
+        cursor = db[q["collection"]].find(q["filter"], {"_id": 0})
+        if q.get("sort"):
+            cursor = cursor.sort(q["sort"])
+        try:
+            explain = await cursor.explain()
+        except OperationFailure as e:
+            queries.append({
+                "endpoint": q["endpoint"],
+                "collection": q["collection"],
+                "error": str(e)
+            })
+            continue
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        stages = plan_stages(winning_plan)
+        queries.append({
+            "endpoint": q["endpoint"],
+            "collection": q["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    
+    return {
+        "build": index_build_status,
+        "collscans": [q["endpoint"] for q in queries if q.get("collscan")],
+        "queries": queries
+    }
+
+@api_router.post("/admin/indexes/rebuild")
+async def rebuild_indexes(admin: dict = Depends(get_admin_user)):
+    global _index_build_task
+    if _index_build_task and not _index_build_task.done():
+        raise HTTPException(status_code=409, detail="La creación de índices ya está en curso")
+    _index_build_task = asyncio.create_task(ensure_indexes())
+    return {"message": "Creación de índices iniciada"}
+
+@api_router.post("/admin/indexes/dedupe")
+async def dedupe_indexes(admin: dict = Depends(get_admin_user)):
+    """Delete rows duplicating a unique natural key, keeping the oldest, then retry the index build"""
+    global _index_build_task
+    if _index_build_task and not _index_build_task.done():
+        raise HTTPException(status_code=409, detail="La creación de índices ya está en curso")
+    removed = {}
+    for collection, keys, options in INDEX_SPECS:
+        if options.get("unique") and collection in DEDUPE_COLLECTIONS:
+            removed[collection] = await dedupe_natural_key(collection, [field for field, _ in keys])
+    _index_build_task = asyncio.create_task(ensure_indexes())
+    return {"message": "Duplicados eliminados, creación de índices iniciada", "removed": removed}
+
+@api_router.get("/admin/migrations")
+async def get_migrations(admin: dict = Depends(get_admin_user)):
+    migrations = await db.migrations.find({}, {"_id": 0, "last_id": 0}).to_list(100)
+    return migrations
+
+@api_router.post("/admin/migrations/incident-dates")
+async def run_incident_dates_migration(admin: dict = Depends(get_admin_user)):
+    global _migration_task
+    if _migration_task and not _migration_task.done():
+        raise HTTPException(status_code=409, detail="La migración ya está en curso")
+    _migration_task = asyncio.create_task(migrate_incident_dates())
+    return {"message": "Migración de fechas de incidencias iniciada"}
+
 # ==================== HUB ROUTES ====================
 
 @api_router.get("/hubs", response_model=List[HubResponse])
@@ -535,17 +1623,21 @@ async def get_hubs(current_user: dict = Depends(get_current_user)):
     ) for h in hubs]
 
 @api_router.get("/hubs/{hub_id}", response_model=HubResponse)
-async def get_hub(hub_id: str, current_user: dict = Depends(get_current_user)):
+async def get_hub(hub_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    etag = resource_etag(hub_id, "hubs")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
     hub = await db.hubs.find_one({"id": hub_id}, {"_id": 0})
     if not hub:
         raise HTTPException(status_code=404, detail="Hub no encontrado")
-    return HubResponse(
+    return cacheable(HubResponse(
         id=hub["id"],
         name=hub["name"],
         description=hub.get("description", ""),
         location=hub.get("location", ""),
         created_at=hub["created_at"]
-    )
+    ).model_dump(), etag)
 
 @api_router.post("/hubs", response_model=HubResponse)
 async def create_hub(hub_data: HubCreate, admin: dict = Depends(get_admin_user)):
@@ -554,9 +1646,11 @@ async def create_hub(hub_data: HubCreate, admin: dict = Depends(get_admin_user))
         "name": hub_data.name,
         "description": hub_data.description,
         "location": hub_data.location,
+        "location_key": get_location_key(f"{hub_data.location} {hub_data.name}"),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.hubs.insert_one(hub)
+    await bump_version("hubs", hub["id"])
     return HubResponse(
         id=hub["id"],
         name=hub["name"],
@@ -576,6 +1670,12 @@ async def update_hub(hub_id: str, hub_data: HubUpdate, admin: dict = Depends(get
         raise HTTPException(status_code=404, detail="Hub no encontrado")
     
     hub = await db.hubs.find_one({"id": hub_id}, {"_id": 0})
+    if "name" in update_data or "location" in update_data:
+        # Holiday presets follow the hub's location
+        location_key = get_location_key(f"{hub.get('location', '')} {hub['name']}")
+        await db.hubs.update_one({"id": hub_id}, {"$set": {"location_key": location_key}})
+        invalidate_working_calendars(hub_id)
+    await bump_version("hubs", hub_id)
     return HubResponse(
         id=hub["id"],
         name=hub["name"],
@@ -593,20 +1693,27 @@ async def delete_hub(hub_id: str, admin: dict = Depends(get_admin_user)):
     await db.employees.delete_many({"hub_id": hub_id})
     await db.attendance.delete_many({"hub_id": hub_id})
     await db.records.delete_many({"hub_id": hub_id})
+    invalidate_working_calendars(hub_id)
+    for collection in ("hubs", "employees"):
+        await bump_version(collection, hub_id)
     return {"message": "Hub eliminado correctamente"}
 
 # ==================== EMPLOYEE ROUTES ====================
 
 @api_router.get("/hubs/{hub_id}/employees", response_model=List[EmployeeResponse])
-async def get_employees(hub_id: str, current_user: dict = Depends(get_current_user)):
+async def get_employees(hub_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    etag = resource_etag(hub_id, "employees")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
     employees = await db.employees.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
-    return [EmployeeResponse(
+    return cacheable([EmployeeResponse(
         id=e["id"],
         hub_id=e["hub_id"],
         name=e["name"],
         position=e.get("position", ""),
         created_at=e["created_at"]
-    ) for e in employees]
+    ).model_dump() for e in employees], etag)
 
 @api_router.post("/hubs/{hub_id}/employees", response_model=EmployeeResponse)
 async def create_employee(hub_id: str, employee_data: EmployeeCreate, admin: dict = Depends(get_admin_user)):
@@ -623,6 +1730,7 @@ async def create_employee(hub_id: str, employee_data: EmployeeCreate, admin: dic
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.employees.insert_one(employee)
+    await bump_version("employees", hub_id)
     return EmployeeResponse(
         id=employee["id"],
         hub_id=employee["hub_id"],
@@ -643,6 +1751,7 @@ async def update_employee(hub_id: str, employee_id: str, employee_data: Employee
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
+    await bump_version("employees", hub_id)
     
     employee = await db.employees.find_one({"id": employee_id}, {"_id": 0})
     return EmployeeResponse(
@@ -659,48 +1768,92 @@ async def delete_employee(hub_id: str, employee_id: str, admin: dict = Depends(g
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
     # Also delete attendance records
-    await db.attendance.delete_many({"employee_id": employee_id})
+    await delete_with_tombstones("attendance", hub_id, {"employee_id": employee_id})
+    await bump_version("employees", hub_id)
     return {"message": "Empleado eliminado correctamente"}
 
 # ==================== ATTENDANCE ROUTES ====================
 
+ATTENDANCE_CELL_PROJECTION = {"_id": 0, "employee_id": 1, "date": 1, "status": 1, "extra_hours": 1, "diet": 1}
+
+def attendance_cell_row(a: dict) -> dict:
+    """One attendance cell as sent by delta sync"""
+    return {
+        "id": a["id"],
+        "employee_id": a["employee_id"],
+        "date": a["date"],
+        "status": a.get("status", ""),
+        "extra_hours": a.get("extra_hours", 0),
+        "diet": a.get("diet", 0)
+    }
+
 @api_router.get("/hubs/{hub_id}/attendance")
 async def get_attendance(
     hub_id: str,
     year: int,
     month: int,
+    response_format: str = Query("rows", alias="format"),
+    since: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    columnar = check_response_format(response_format)
+    
     # Get all attendance for the hub in the specified month
     start_date = f"{year}-{month:02d}-01"
     last_day = calendar.monthrange(year, month)[1]
     end_date = f"{year}-{month:02d}-{last_day}"
-    
-    attendance = await db.attendance.find({
+    query = {
         "hub_id": hub_id,
         "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
+    }
+    if since is not None:
+        return await changes_since(
+            db.attendance, query, since, attendance_cell_row, {**ATTENDANCE_CELL_PROJECTION, "id": 1}, columnar
+        )
+    cells = db.attendance.find(query, ATTENDANCE_CELL_PROJECTION)
+    
+    if columnar:
+        # One day-indexed array per employee and field; null where there is no cell
+        employee_rows = {}
+        statuses = DictionaryEncoder()
+        async for a in cells:
+            grid = employee_rows.get(a["employee_id"])
+            if grid is None:
+                grid = employee_rows[a["employee_id"]] = {field: [None] * last_day for field in ("status", "extra_hours", "diet")}
+            day = int(a["date"][8:10]) - 1
+            grid["status"][day] = statuses.encode(a.get("status", ""))
+            grid["extra_hours"][day] = a.get("extra_hours", 0)
+            grid["diet"][day] = a.get("diet", 0)
+        attendance = {
+            "employee_ids": list(employee_rows),
+            "statuses": statuses.values,
+            **{field: [grid[field] for grid in employee_rows.values()] for field in ("status", "extra_hours", "diet")}
+        }
+    else:
+        # Build attendance matrix straight from the cursor, fetching only the cell fields
+        attendance = {}
+        async for a in cells:
+            key = f"{a['employee_id']}_{a['date']}"
+            attendance[key] = {
+                "status": a.get("status", ""),
+                "extra_hours": a.get("extra_hours", 0),
+                "diet": a.get("diet", 0)
+            }
     
     # Get employees for this hub
     employees = await db.employees.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
     
-    # Build attendance matrix
-    attendance_map = {}
-    for a in attendance:
-        key = f"{a['employee_id']}_{a['date']}"
-        attendance_map[key] = {
-            "status": a.get("status", ""),
-            "extra_hours": a.get("extra_hours", 0),
-            "diet": a.get("diet", 0)
-        }
-    
-    return {
+    # Plain dicts from Mongo: serialize directly, no response validation pass
+    response = {
         "employees": employees,
-        "attendance": attendance_map,
+        "attendance": attendance,
         "year": year,
         "month": month,
         "days_in_month": last_day
     }
+    if columnar:
+        response["format"] = "columnar"
+    return ORJSONResponse(response)
 
 @api_router.post("/hubs/{hub_id}/attendance")
 async def save_attendance(
@@ -708,33 +1861,57 @@ async def save_attendance(
     data: AttendanceBulkUpdate,
     current_user: dict = Depends(get_current_user)
 ):
-    # Process each entry
+    # One upsert per (employee, date); the last entry wins if a cell is repeated
+    operations = {}
+    now = utc_timestamp()
     for entry in data.entries:
-        existing = await db.attendance.find_one({
-            "employee_id": entry.employee_id,
-            "hub_id": hub_id,
-            "date": entry.date
-        })
-        
         attendance_doc = {
             "employee_id": entry.employee_id,
             "hub_id": hub_id,
             "date": entry.date,
             "status": entry.status,
             "extra_hours": entry.extra_hours or 0,
-            "diet": entry.diet or 0
+            "diet": entry.diet or 0,
+            "updated_at": now
         }
-        
-        if existing:
-            await db.attendance.update_one(
-                {"_id": existing["_id"]},
-                {"$set": attendance_doc}
-            )
-        else:
-            attendance_doc["id"] = str(uuid.uuid4())
-            await db.attendance.insert_one(attendance_doc)
+        operations[(entry.employee_id, entry.date)] = UpdateOne(
+            {"employee_id": entry.employee_id, "hub_id": hub_id, "date": entry.date},
+            {"$set": attendance_doc, "$setOnInsert": {"id": str(uuid.uuid4())}},
+            upsert=True
+        )
+    
+    keys = list(operations.keys())
+    details, write_errors = await bulk_upsert(db.attendance, list(operations.values()))
+    if write_errors:
+        logging.error(f"Errores guardando asistencia del hub {hub_id}: {write_errors}")
+        raise HTTPException(status_code=409, detail={
+            "message": "Algunas celdas no se pudieron guardar",
+            "matched": details.get("nMatched", 0),
+            "upserted": details.get("nUpserted", 0),
+            "modified": details.get("nModified", 0),
+            "errors": [
+                {"employee_id": keys[op_index][0], "date": keys[op_index][1], "error": errmsg}
+                for op_index, errmsg in write_errors.items()
+            ]
+        })
     
-    return {"message": "Asistencia guardada correctamente", "count": len(data.entries)}
+    return {
+        "message": "Asistencia guardada correctamente",
+        "count": len(data.entries),
+        "matched": details.get("nMatched", 0),
+        "upserted": details.get("nUpserted", 0),
+        "modified": details.get("nModified", 0)
+    }
+
+def empty_attendance_totals() -> dict:
+    return {
+        **{field: 0 for field in ATTENDANCE_STATUS_FIELDS.values()},
+        "total_extra_hours": 0,
+        "total_diets": 0,
+        "holidays_worked": 0,
+        "weekend_days_worked": 0,
+        "unknown_statuses": {}
+    }
 
 @api_router.get("/hubs/{hub_id}/attendance/summary")
 async def get_attendance_summary(
@@ -747,62 +1924,93 @@ async def get_attendance_summary(
     last_day = calendar.monthrange(year, month)[1]
     end_date = f"{year}-{month:02d}-{last_day}"
     
+    cal = await working_calendar(hub_id, year, month)
+    holiday_dates = [h["date"] for h in cal["holidays"]]
+    
     # Get employees
     employees = await db.employees.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
     
-    # Get attendance
-    attendance = await db.attendance.find({
-        "hub_id": hub_id,
-        "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
+    # Counts per (employee, status) in one grouped pass
+    pipeline = [
+        {"$match": {"hub_id": hub_id, "date": {"$gte": start_date, "$lte": end_date}}},
+        {"$group": {
+            "_id": {"employee_id": "$employee_id", "status": {"$ifNull": ["$status", ""]}},
+            "days": {"$sum": 1},
+            "extra_hours": {"$sum": {"$ifNull": ["$extra_hours", 0]}},
+            "diets": {"$sum": {"$cond": [{"$eq": ["$diet", 1]}, 1, 0]}},
+            "on_holidays": {"$sum": {"$cond": [{"$in": ["$date", holiday_dates]}, 1, 0]}},
+            "on_weekends": {"$sum": {"$cond": [{"$in": ["$date", cal["weekend_dates"]]}, 1, 0]}}
+        }}
+    ]
     
-    # Calculate summary per employee
-    summary = []
-    for emp in employees:
-        emp_attendance = [a for a in attendance if a["employee_id"] == emp["id"]]
-        
-        days_worked = sum(1 for a in emp_attendance if a.get("status") == "1")
-        days_rest = sum(1 for a in emp_attendance if a.get("status") == "D")
-        days_absent = sum(1 for a in emp_attendance if a.get("status") == "IN")
-        days_sick = sum(1 for a in emp_attendance if a.get("status") == "E")
-        days_other = sum(1 for a in emp_attendance if a.get("status") == "O")
-        total_extra_hours = sum(a.get("extra_hours", 0) for a in emp_attendance)
-        total_diets = sum(1 for a in emp_attendance if a.get("diet") == 1)
-        
-        summary.append({
-            "employee_id": emp["id"],
-            "employee_name": emp["name"],
-            "days_worked": days_worked,
-            "days_rest": days_rest,
-            "days_absent": days_absent,
-            "days_sick": days_sick,
-            "days_other": days_other,
-            "total_extra_hours": total_extra_hours,
-            "total_diets": total_diets
-        })
+    totals = {}
+    unknown_statuses = set()
+    async for group in db.attendance.aggregate(pipeline):
+        employee_id = group["_id"]["employee_id"]
+        status = group["_id"]["status"]
+        emp_totals = totals.setdefault(employee_id, empty_attendance_totals())
+        if status in ATTENDANCE_STATUS_FIELDS:
+            emp_totals[ATTENDANCE_STATUS_FIELDS[status]] += group["days"]
+            if status == "1":
+                emp_totals["holidays_worked"] += group["on_holidays"]
+                emp_totals["weekend_days_worked"] += group["on_weekends"]
+        elif status:
+            # Cells with only extra hours or diet have an empty status; anything else is unexpected
+            emp_totals["unknown_statuses"][status] = group["days"]
+            unknown_statuses.add(status)
+        emp_totals["total_extra_hours"] += group["extra_hours"]
+        emp_totals["total_diets"] += group["diets"]
+    
+    summary = [{
+        "employee_id": emp["id"],
+        "employee_name": emp["name"],
+        "expected_days": cal["working_days"],
+        **totals.get(emp["id"], empty_attendance_totals())
+    } for emp in employees]
     
     return {
         "summary": summary,
+        "unknown_statuses": sorted(unknown_statuses),
+        "expected_days": cal["working_days"],
+        "holidays": cal["holidays"],
         "year": year,
         "month": month
     }
 
 # ==================== VEHICLE ROUTES (FLOTA) ====================
 
+VEHICLE_LIST_PROJECTION = response_projection(VehicleResponse, [])
+
+def vehicle_row(v: dict) -> dict:
+    """VehicleResponse fields of a trusted vehicles doc"""
+    return {
+        "id": v["id"],
+        "hub_id": v["hub_id"],
+        "plate": v["plate"],
+        "vehicle_type": v["vehicle_type"],
+        "created_at": v["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/vehicles")
-async def get_vehicles(hub_id: str, current_user: dict = Depends(get_current_user)):
-    vehicles = await db.vehicles.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
-    return [VehicleResponse(
-        id=v["id"],
-        hub_id=v["hub_id"],
-        plate=v["plate"],
-        vehicle_type=v["vehicle_type"],
-        created_at=v["created_at"]
-    ) for v in vehicles]
+async def get_vehicles(hub_id: str, request: Request, since: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    if since is not None:
+        return await changes_since(db.vehicles, {"hub_id": hub_id}, since, vehicle_row, VEHICLE_LIST_PROJECTION)
+    
+    etag = resource_etag(hub_id, "vehicles")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    vehicles = await db.vehicles.find({"hub_id": hub_id}, VEHICLE_LIST_PROJECTION).to_list(500)
+    return cacheable([vehicle_row(v) for v in vehicles], etag)
+
+VEHICLE_TYPES_ETAG = static_etag(VEHICLE_TYPES)
 
 @api_router.get("/vehicle-types")
-async def get_vehicle_types(current_user: dict = Depends(get_current_user)):
-    return VEHICLE_TYPES
+async def get_vehicle_types(request: Request, current_user: dict = Depends(get_current_user)):
+    cache_control = f"private, max-age={STATIC_CACHE_SECONDS}"
+    if etag_matches(request, VEHICLE_TYPES_ETAG):
+        return not_modified(VEHICLE_TYPES_ETAG, cache_control)
+    return cacheable(VEHICLE_TYPES, VEHICLE_TYPES_ETAG, cache_control)
 
 @api_router.post("/hubs/{hub_id}/vehicles", response_model=VehicleResponse)
 async def create_vehicle(hub_id: str, vehicle_data: VehicleCreate, admin: dict = Depends(get_admin_user)):
@@ -821,9 +2029,11 @@ async def create_vehicle(hub_id: str, vehicle_data: VehicleCreate, admin: dict =
         "hub_id": hub_id,
         "plate": vehicle_data.plate.upper(),
         "vehicle_type": vehicle_data.vehicle_type,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": utc_timestamp()
     }
     await db.vehicles.insert_one(vehicle)
+    await bump_version("vehicles", hub_id)
     return VehicleResponse(
         id=vehicle["id"],
         hub_id=vehicle["hub_id"],
@@ -842,6 +2052,7 @@ async def update_vehicle(hub_id: str, vehicle_id: str, vehicle_data: VehicleUpda
     
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    update_data["updated_at"] = utc_timestamp()
     
     result = await db.vehicles.update_one(
         {"id": vehicle_id, "hub_id": hub_id},
@@ -849,6 +2060,7 @@ async def update_vehicle(hub_id: str, vehicle_id: str, vehicle_data: VehicleUpda
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
+    await bump_version("vehicles", hub_id)
     
     vehicle = await db.vehicles.find_one({"id": vehicle_id}, {"_id": 0})
     return VehicleResponse(
@@ -865,87 +2077,110 @@ async def delete_vehicle(hub_id: str, vehicle_id: str, admin: dict = Depends(get
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     # Also delete related incidents
-    await db.incidents.delete_many({"vehicle_id": vehicle_id})
+    await record_tombstones("vehicles", hub_id, [vehicle_id])
+    await delete_with_tombstones("incidents", hub_id, {"vehicle_id": vehicle_id})
+    await bump_version("vehicles", hub_id)
     return {"message": "Vehículo eliminado correctamente"}
 
 # ==================== INCIDENT ROUTES (HISTORICO DE INCIDENCIAS) ====================
 
+INCIDENT_LIST_PROJECTION = response_projection(IncidentResponse, INCIDENTS_SORT)
+
+def incident_row(i: dict) -> dict:
+    """IncidentResponse fields of a trusted incidents doc"""
+    return {
+        "id": i["id"],
+        "vehicle_id": i["vehicle_id"],
+        "hub_id": i["hub_id"],
+        "title": i["title"],
+        "description": i.get("description", ""),
+        "date": i["date"],
+        "cost": float(i.get("cost", 0)),
+        "km": int(i.get("km", 0)),
+        "created_at": i["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/incidents")
 async def get_incidents(
     hub_id: str,
     vehicle_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    since: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {"hub_id": hub_id}
     if vehicle_id:
         query["vehicle_id"] = vehicle_id
     
-    incidents = await db.incidents.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
-    return [IncidentResponse(
-        id=i["id"],
-        vehicle_id=i["vehicle_id"],
-        hub_id=i["hub_id"],
-        title=i["title"],
-        description=i.get("description", ""),
-        date=i["date"],
-        cost=i.get("cost", 0),
-        km=i.get("km", 0),
-        created_at=i["created_at"]
-    ) for i in incidents]
+    if since is not None:
+        # The date of an incident can be edited, so a delta ignores date_from/date_to:
+        # a row moved out of the range must still reach the client
+        paged = limit is not None or cursor is not None
+        return await changes_since(db.incidents, query, since, incident_row, INCIDENT_LIST_PROJECTION, paged)
+    
+    # Range filters run on the canonical date, served by the (hub_id, date_iso) index
+    date_range = {}
+    for op, value in (("$gte", date_from), ("$lte", date_to)):
+        if value:
+            date_iso = normalize_date(value)
+            if not date_iso:
+                raise HTTPException(status_code=400, detail="Fecha inválida")
+            date_range[op] = date_iso
+    if date_range:
+        query["date_iso"] = date_range
+    
+    return await paginate(db.incidents, query, INCIDENTS_SORT, incident_row, limit, cursor, total, INCIDENT_LIST_PROJECTION)
 
 @api_router.get("/hubs/{hub_id}/incidents/summary")
 async def get_incidents_summary(
     hub_id: str,
+    year: Optional[int] = Query(None, ge=1, le=9999),
+    month: Optional[int] = Query(None, ge=1, le=12),
     current_user: dict = Depends(get_current_user)
 ):
     # Get all vehicles for this hub
     vehicles = await db.vehicles.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
     
-    # Get current month and year
+    # Default to the current month and year
     now = datetime.now(timezone.utc)
-    current_month = now.month
-    current_year = now.year
+    current_year = now.year if year is None else year
+    current_month = now.month if month is None else month
+    
+    # date_iso is YYYY-MM-DD, so month and year buckets are string prefixes
+    year_prefix = f"{current_year}-"
+    month_prefix = f"{current_year}-{current_month:02d}-"
+    date_iso = {"$ifNull": ["$date_iso", ""]}
+    pipeline = [
+        {"$match": {"hub_id": hub_id, "vehicle_id": {"$in": [v["id"] for v in vehicles]}}},
+        {"$project": {
+            "vehicle_id": 1,
+            "cost": {"$ifNull": ["$cost", 0]},
+            "year": {"$substrBytes": [date_iso, 0, len(year_prefix)]},
+            "month": {"$substrBytes": [date_iso, 0, len(month_prefix)]}
+        }},
+        {"$group": {
+            "_id": "$vehicle_id",
+            "incidents_count": {"$sum": 1},
+            "total_cost_year": {"$sum": {"$cond": [{"$eq": ["$year", year_prefix]}, "$cost", 0]}},
+            "total_cost_month": {"$sum": {"$cond": [{"$eq": ["$month", month_prefix]}, "$cost", 0]}}
+        }}
+    ]
+    totals = {t["_id"]: t async for t in db.incidents.aggregate(pipeline)}
     
-    # Calculate summaries per vehicle
     summaries = []
     for vehicle in vehicles:
-        incidents = await db.incidents.find(
-            {"vehicle_id": vehicle["id"]}, 
-            {"_id": 0}
-        ).to_list(1000)
-        
-        # Calculate totals
-        total_cost_month = 0
-        total_cost_year = 0
-        
-        for incident in incidents:
-            cost = incident.get("cost", 0)
-            # Parse date (supports both DD/MM/YYYY and YYYY-MM-DD)
-            date_str = incident.get("date", "")
-            try:
-                if "/" in date_str:
-                    parts = date_str.split("/")
-                    incident_month = int(parts[1])
-                    incident_year = int(parts[2])
-                else:
-                    parts = date_str.split("-")
-                    incident_year = int(parts[0])
-                    incident_month = int(parts[1])
-                
-                if incident_year == current_year:
-                    total_cost_year += cost
-                    if incident_month == current_month:
-                        total_cost_month += cost
-            except:
-                pass
-        
+        vehicle_totals = totals.get(vehicle["id"], {})
         summaries.append({
             "vehicle_id": vehicle["id"],
             "plate": vehicle["plate"],
             "vehicle_type": vehicle["vehicle_type"],
-            "total_cost_month": total_cost_month,
-            "total_cost_year": total_cost_year,
-            "incidents_count": len(incidents)
+            "total_cost_month": vehicle_totals.get("total_cost_month", 0),
+            "total_cost_year": vehicle_totals.get("total_cost_year", 0),
+            "incidents_count": vehicle_totals.get("incidents_count", 0)
         })
     
     return {
@@ -961,6 +2196,10 @@ async def create_incident(hub_id: str, incident_data: IncidentCreate, current_us
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     
+    date_iso = normalize_date(incident_data.date)
+    if not date_iso:
+        raise HTTPException(status_code=400, detail="Fecha inválida, use DD/MM/YYYY o YYYY-MM-DD")
+    
     incident = {
         "id": str(uuid.uuid4()),
         "vehicle_id": incident_data.vehicle_id,
@@ -968,9 +2207,11 @@ async def create_incident(hub_id: str, incident_data: IncidentCreate, current_us
         "title": incident_data.title,
         "description": incident_data.description or "",
         "date": incident_data.date,
+        "date_iso": date_iso,
         "cost": incident_data.cost or 0,
         "km": incident_data.km or 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": utc_timestamp()
     }
     await db.incidents.insert_one(incident)
     return IncidentResponse(
@@ -992,6 +2233,12 @@ async def update_incident(hub_id: str, incident_id: str, incident_data: Incident
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
     
+    if "date" in update_data:
+        update_data["date_iso"] = normalize_date(update_data["date"])
+        if not update_data["date_iso"]:
+            raise HTTPException(status_code=400, detail="Fecha inválida, use DD/MM/YYYY o YYYY-MM-DD")
+    update_data["updated_at"] = utc_timestamp()
+    
     result = await db.incidents.update_one(
         {"id": incident_id, "hub_id": hub_id},
         {"$set": update_data}
@@ -1017,24 +2264,42 @@ async def delete_incident(hub_id: str, incident_id: str, current_user: dict = De
     result = await db.incidents.delete_one({"id": incident_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Incidencia no encontrada")
+    await record_tombstones("incidents", hub_id, [incident_id])
     return {"message": "Incidencia eliminada correctamente"}
 
 # ==================== PURCHASE ROUTES (COMPRAS) ====================
 
+PURCHASE_LIST_PROJECTION = response_projection(PurchaseResponse, CREATED_SORT)
+
+def purchase_row(p: dict) -> dict:
+    """PurchaseResponse fields of a trusted purchases doc"""
+    price = p.get("price", 1)
+    quantity = p.get("quantity", 1)
+    return {
+        "id": p["id"],
+        "hub_id": p["hub_id"],
+        "item": p["item"],
+        "specifications": p.get("specifications", ""),
+        "supplier": p.get("supplier", ""),
+        "price": float(price),
+        "quantity": int(quantity),
+        "total": float(p.get("total", price * quantity)),
+        "created_at": p["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/purchases")
-async def get_purchases(hub_id: str, current_user: dict = Depends(get_current_user)):
-    purchases = await db.purchases.find({"hub_id": hub_id}, {"_id": 0}).to_list(1000)
-    return [PurchaseResponse(
-        id=p["id"],
-        hub_id=p["hub_id"],
-        item=p["item"],
-        specifications=p.get("specifications", ""),
-        supplier=p.get("supplier", ""),
-        price=p.get("price", 1),
-        quantity=p.get("quantity", 1),
-        total=p.get("total", p.get("price", 1) * p.get("quantity", 1)),
-        created_at=p["created_at"]
-    ) for p in purchases]
+async def get_purchases(
+    hub_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if since is not None:
+        paged = limit is not None or cursor is not None
+        return await changes_since(db.purchases, {"hub_id": hub_id}, since, purchase_row, PURCHASE_LIST_PROJECTION, paged)
+    return await paginate(db.purchases, {"hub_id": hub_id}, CREATED_SORT, purchase_row, limit, cursor, total, PURCHASE_LIST_PROJECTION)
 
 @api_router.post("/hubs/{hub_id}/purchases", response_model=PurchaseResponse)
 async def create_purchase(hub_id: str, purchase_data: PurchaseCreate, current_user: dict = Depends(get_current_user)):
@@ -1055,7 +2320,8 @@ async def create_purchase(hub_id: str, purchase_data: PurchaseCreate, current_us
         "price": price,
         "quantity": quantity,
         "total": total,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": utc_timestamp()
     }
     await db.purchases.insert_one(purchase)
     return PurchaseResponse(
@@ -1084,6 +2350,7 @@ async def update_purchase(hub_id: str, purchase_id: str, purchase_data: Purchase
     
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    update_data["updated_at"] = utc_timestamp()
     
     result = await db.purchases.update_one(
         {"id": purchase_id, "hub_id": hub_id},
@@ -1110,21 +2377,37 @@ async def delete_purchase(hub_id: str, purchase_id: str, current_user: dict = De
     result = await db.purchases.delete_one({"id": purchase_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Compra no encontrada")
+    await record_tombstones("purchases", hub_id, [purchase_id])
     return {"message": "Compra eliminada correctamente"}
 
 # ==================== CONTACT ROUTES (CONTACTOS) ====================
 
+CONTACT_LIST_PROJECTION = response_projection(ContactResponse, CREATED_SORT)
+
+def contact_row(c: dict) -> dict:
+    """ContactResponse fields of a trusted contacts doc"""
+    return {
+        "id": c["id"],
+        "hub_id": c["hub_id"],
+        "name": c["name"],
+        "position": c.get("position", ""),
+        "phone": c.get("phone", ""),
+        "created_at": c["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/contacts")
-async def get_contacts(hub_id: str, current_user: dict = Depends(get_current_user)):
-    contacts = await db.contacts.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
-    return [ContactResponse(
-        id=c["id"],
-        hub_id=c["hub_id"],
-        name=c["name"],
-        position=c.get("position", ""),
-        phone=c.get("phone", ""),
-        created_at=c["created_at"]
-    ) for c in contacts]
+async def get_contacts(
+    hub_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if since is not None:
+        paged = limit is not None or cursor is not None
+        return await changes_since(db.contacts, {"hub_id": hub_id}, since, contact_row, CONTACT_LIST_PROJECTION, paged)
+    return await paginate(db.contacts, {"hub_id": hub_id}, CREATED_SORT, contact_row, limit, cursor, total, CONTACT_LIST_PROJECTION)
 
 @api_router.post("/hubs/{hub_id}/contacts", response_model=ContactResponse)
 async def create_contact(hub_id: str, contact_data: ContactCreate, current_user: dict = Depends(get_current_user)):
@@ -1138,7 +2421,8 @@ async def create_contact(hub_id: str, contact_data: ContactCreate, current_user:
         "name": contact_data.name,
         "position": contact_data.position or "",
         "phone": contact_data.phone or "",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": utc_timestamp()
     }
     await db.contacts.insert_one(contact)
     return ContactResponse(
@@ -1156,6 +2440,7 @@ async def update_contact(hub_id: str, contact_id: str, contact_data: ContactUpda
     
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    update_data["updated_at"] = utc_timestamp()
     
     result = await db.contacts.update_one(
         {"id": contact_id, "hub_id": hub_id},
@@ -1179,19 +2464,24 @@ async def delete_contact(hub_id: str, contact_id: str, current_user: dict = Depe
     result = await db.contacts.delete_one({"id": contact_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Contacto no encontrado")
+    await record_tombstones("contacts", hub_id, [contact_id])
     return {"message": "Contacto eliminado correctamente"}
 
 # ==================== LIQUIDATION ROUTES ====================
 
 @api_router.get("/hubs/{hub_id}/routes")
-async def get_routes(hub_id: str, current_user: dict = Depends(get_current_user)):
+async def get_routes(hub_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    etag = resource_etag(hub_id, "routes")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
     routes = await db.routes.find({"hub_id": hub_id}, {"_id": 0}).sort("name", 1).to_list(500)
-    return [RouteResponse(
+    return cacheable([RouteResponse(
         id=r["id"],
         hub_id=r["hub_id"],
         name=r["name"],
         created_at=r["created_at"]
-    ) for r in routes]
+    ).model_dump() for r in routes], etag)
 
 @api_router.post("/hubs/{hub_id}/routes", response_model=RouteResponse)
 async def create_route(hub_id: str, route_data: RouteCreate, current_user: dict = Depends(get_current_user)):
@@ -1211,6 +2501,7 @@ async def create_route(hub_id: str, route_data: RouteCreate, current_user: dict
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.routes.insert_one(route)
+    await bump_version("routes", hub_id)
     return RouteResponse(
         id=route["id"],
         hub_id=route["hub_id"],
@@ -1223,18 +2514,46 @@ async def delete_route(hub_id: str, route_id: str, current_user: dict = Depends(
     result = await db.routes.delete_one({"id": route_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Ruta no encontrada")
-    # Also delete related liquidation entries
-    await db.liquidations.delete_many({"route_id": route_id})
+    await bump_version("routes", hub_id)
+    # Also delete related liquidation entries, reversing them in the ledger
+    removed = await delete_with_tombstones("liquidations", hub_id, {"route_id": route_id}, LEDGER_PROJECTION)
+    await apply_liquidation_ledger([(entry, None) for entry in removed])
     return {"message": "Ruta eliminada correctamente"}
 
+LIQUIDATION_LIST_PROJECTION = response_projection(LiquidationEntryResponse, DATE_SORT)
+
+def liquidation_row(e: dict) -> dict:
+    """LiquidationEntryResponse fields of a trusted liquidations doc"""
+    metalico = e.get("metalico", 0)
+    ingreso = e.get("ingreso", 0)
+    return {
+        "id": e["id"],
+        "route_id": e["route_id"],
+        "hub_id": e["hub_id"],
+        "date": e["date"],
+        "repartidor": e.get("repartidor", ""),
+        "metalico": float(metalico),
+        "ingreso": float(ingreso),
+        "diferencia": float(metalico - ingreso),
+        "comentario": e.get("comentario", ""),
+        "created_at": e["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/liquidations")
 async def get_liquidations(
     hub_id: str,
     year: int,
     month: int,
     route_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    response_format: str = Query("rows", alias="format"),
+    since: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    columnar = check_response_format(response_format, limit, cursor)
+    
     # Build date range
     start_date = f"{year}-{month:02d}-01"
     last_day = calendar.monthrange(year, month)[1]
@@ -1247,20 +2566,40 @@ async def get_liquidations(
     if route_id:
         query["route_id"] = route_id
     
-    entries = await db.liquidations.find(query, {"_id": 0}).sort("date", 1).to_list(10000)
-    
-    return [LiquidationEntryResponse(
-        id=e["id"],
-        route_id=e["route_id"],
-        hub_id=e["hub_id"],
-        date=e["date"],
-        repartidor=e.get("repartidor", ""),
-        metalico=e.get("metalico", 0),
-        ingreso=e.get("ingreso", 0),
-        diferencia=e.get("metalico", 0) - e.get("ingreso", 0),
-        comentario=e.get("comentario", ""),
-        created_at=e["created_at"]
-    ) for e in entries]
+    if since is not None:
+        paged = columnar or limit is not None or cursor is not None
+        return await changes_since(db.liquidations, query, since, liquidation_row, LIQUIDATION_LIST_PROJECTION, paged)
+    if columnar:
+        return await columnar_month(
+            db.liquidations, query, DATE_SORT, liquidation_row, LIQUIDATION_LIST_PROJECTION,
+            ["route_id", "repartidor"], {"hub_id": hub_id, "year": year, "month": month, "days_in_month": last_day}
+        )
+    return await paginate(db.liquidations, query, DATE_SORT, liquidation_row, limit, cursor, total, LIQUIDATION_LIST_PROJECTION)
+
+async def upsert_liquidation(hub_id: str, route_id: str, date: str, values: dict, now: str) -> tuple:
+    """Atomic upsert of one (route, date) row. Returns (previous row or None, row as saved)"""
+    on_insert = {
+        "id": str(uuid.uuid4()),
+        "route_id": route_id,
+        "hub_id": hub_id,
+        "date": date,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    arguments = (
+        {"route_id": route_id, "date": date},
+        {"$set": {**values, "updated_at": now}, "$setOnInsert": on_insert}
+    )
+    try:
+        previous = await db.liquidations.find_one_and_update(
+            *arguments, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert inserted the row first; it exists now, so this one updates it
+        previous = await db.liquidations.find_one_and_update(
+            *arguments, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    entry = {**previous, **values} if previous else {**on_insert, **values}
+    return previous, entry
 
 @api_router.post("/hubs/{hub_id}/liquidations", response_model=LiquidationEntryResponse)
 async def create_liquidation_entry(hub_id: str, entry_data: LiquidationEntryCreate, current_user: dict = Depends(get_current_user)):
@@ -1269,44 +2608,23 @@ async def create_liquidation_entry(hub_id: str, entry_data: LiquidationEntryCrea
     if not route:
         raise HTTPException(status_code=404, detail="Ruta no encontrada")
     
+    if not is_valid_date(entry_data.date):
+        raise HTTPException(status_code=400, detail="Fecha inválida, se espera YYYY-MM-DD")
+    
     # Enforce lowercase for repartidor
     repartidor = entry_data.repartidor.lower() if entry_data.repartidor else ""
     
-    # Check if entry already exists for this date and route
-    existing = await db.liquidations.find_one({
-        "route_id": entry_data.route_id,
-        "date": entry_data.date
-    })
+    values = {
+        "repartidor": repartidor,
+        "metalico": entry_data.metalico or 0,
+        "ingreso": entry_data.ingreso or 0,
+        "comentario": entry_data.comentario or ""
+    }
     
-    metalico = entry_data.metalico or 0
-    ingreso = entry_data.ingreso or 0
+    # Upsert the entry for this date and route, keeping its previous values for the ledger
+    existing, entry = await upsert_liquidation(hub_id, entry_data.route_id, entry_data.date, values, utc_timestamp())
     
-    if existing:
-        # Update existing entry
-        await db.liquidations.update_one(
-            {"id": existing["id"]},
-            {"$set": {
-                "repartidor": repartidor,
-                "metalico": metalico,
-                "ingreso": ingreso,
-                "comentario": entry_data.comentario or ""
-            }}
-        )
-        entry = await db.liquidations.find_one({"id": existing["id"]}, {"_id": 0})
-    else:
-        # Create new entry
-        entry = {
-            "id": str(uuid.uuid4()),
-            "route_id": entry_data.route_id,
-            "hub_id": hub_id,
-            "date": entry_data.date,
-            "repartidor": repartidor,
-            "metalico": metalico,
-            "ingreso": ingreso,
-            "comentario": entry_data.comentario or "",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.liquidations.insert_one(entry)
+    await apply_liquidation_ledger([(existing, entry)])
     
     return LiquidationEntryResponse(
         id=entry["id"],
@@ -1337,14 +2655,17 @@ async def update_liquidation_entry(hub_id: str, entry_id: str, entry_data: Liqui
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
     
-    result = await db.liquidations.update_one(
+    previous = await db.liquidations.find_one_and_update(
         {"id": entry_id, "hub_id": hub_id},
-        {"$set": update_data}
+        {"$set": {**update_data, "updated_at": utc_timestamp()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
-    if result.matched_count == 0:
+    if not previous:
         raise HTTPException(status_code=404, detail="Entrada no encontrada")
     
-    entry = await db.liquidations.find_one({"id": entry_id}, {"_id": 0})
+    entry = {**previous, **update_data}
+    await apply_liquidation_ledger([(previous, entry)])
     return LiquidationEntryResponse(
         id=entry["id"],
         route_id=entry["route_id"],
@@ -1359,55 +2680,216 @@ async def update_liquidation_entry(hub_id: str, entry_id: str, entry_data: Liqui
     )
 
 @api_router.post("/hubs/{hub_id}/liquidations/bulk")
-async def save_liquidations_bulk(hub_id: str, entries: List[LiquidationEntryCreate], current_user: dict = Depends(get_current_user)):
-    saved_count = 0
-    for entry_data in entries:
-        repartidor = entry_data.repartidor.lower() if entry_data.repartidor else ""
-        metalico = entry_data.metalico or 0
-        ingreso = entry_data.ingreso or 0
+async def save_liquidations_bulk(hub_id: str, entries: List[Dict[str, Any]], current_user: dict = Depends(get_current_user)):
+    valid_entries, errors = validate_bulk_entries(entries, LiquidationEntryCreate)
+    
+    # Validate each distinct route once
+    route_ids = list({entry.route_id for _, entry in valid_entries})
+    known_routes = await db.routes.find(
+        {"hub_id": hub_id, "id": {"$in": route_ids}}, {"_id": 0, "id": 1}
+    ).to_list(len(route_ids) or 1)
+    known_route_ids = {r["id"] for r in known_routes}
+    
+    # One upsert per (route, date); the last entry wins if a day is repeated
+    operations = {}
+    now = utc_timestamp()
+    for index, entry_data in valid_entries:
+        if entry_data.route_id not in known_route_ids:
+            errors.append({"index": index, "field": "route_id", "error": "Ruta no encontrada"})
+            continue
         
-        existing = await db.liquidations.find_one({
-            "route_id": entry_data.route_id,
-            "date": entry_data.date
-        })
-        
-        if existing:
-            await db.liquidations.update_one(
-                {"id": existing["id"]},
-                {"$set": {
-                    "repartidor": repartidor,
-                    "metalico": metalico,
-                    "ingreso": ingreso,
-                    "comentario": entry_data.comentario or ""
-                }}
-            )
-        else:
-            entry = {
-                "id": str(uuid.uuid4()),
-                "route_id": entry_data.route_id,
-                "hub_id": hub_id,
-                "date": entry_data.date,
-                "repartidor": repartidor,
-                "metalico": metalico,
-                "ingreso": ingreso,
-                "comentario": entry_data.comentario or "",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.liquidations.insert_one(entry)
-        saved_count += 1
+        values = {
+            "repartidor": entry_data.repartidor.lower() if entry_data.repartidor else "",
+            "metalico": entry_data.metalico or 0,
+            "ingreso": entry_data.ingreso or 0,
+            "comentario": entry_data.comentario or ""
+        }
+        operations[(entry_data.route_id, entry_data.date)] = (index, values, UpdateOne(
+            {"route_id": entry_data.route_id, "date": entry_data.date},
+            {
+                "$set": {**values, "updated_at": now},
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "route_id": entry_data.route_id,
+                    "hub_id": hub_id,
+                    "date": entry_data.date,
+                    "created_at": datetime.now(timezone.utc).isoformat()
+                }
+            },
+            upsert=True
+        ))
+    
+    # Previous values of the rows about to be overwritten, for the ledger deltas.
+    # Read separately from the write: two pastes of the same day at the same time
+    # both see the same previous row and the ledger drifts by one delta until
+    # POST /admin/ledger/liquidations/rebuild recomputes it from the rows.
+    keys = list(operations.keys())
+    previous = {}
+    if keys:
+        existing_rows = await db.liquidations.find(
+            {"route_id": {"$in": list({k[0] for k in keys})}, "date": {"$in": list({k[1] for k in keys})}},
+            {"_id": 0, **LEDGER_PROJECTION}
+        ).to_list(None)
+        previous = {(r["route_id"], r["date"]): r for r in existing_rows}
+    
+    indexes = [index for index, _, _ in operations.values()]
+    details, write_errors = await bulk_upsert(db.liquidations, [op for _, _, op in operations.values()])
+    for op_index, errmsg in write_errors.items():
+        errors.append({"index": indexes[op_index], "field": None, "error": errmsg})
+    errors.sort(key=lambda err: err["index"])
+    
+    ledger_changes = []
+    for op_index, key in enumerate(keys):
+        if op_index in write_errors:
+            continue
+        old = previous.get(key)
+        new = {"hub_id": old["hub_id"] if old else hub_id, "route_id": key[0], "date": key[1], **operations[key][1]}
+        ledger_changes.append((old, new))
+    await apply_liquidation_ledger(ledger_changes)
     
-    return {"message": f"Guardadas {saved_count} entradas", "count": saved_count}
+    saved_count = len(operations) - len(write_errors)
+    return {
+        "message": f"Guardadas {saved_count} entradas",
+        "count": saved_count,
+        "matched": details.get("nMatched", 0),
+        "upserted": details.get("nUpserted", 0),
+        "modified": details.get("nModified", 0),
+        "errors": errors
+    }
 
 # ==================== KILOS/LITROS ROUTES ====================
 
+# Numeric fields summed by the kilos/litros summaries
+KILOS_LITROS_FIELDS = ["clientes", "kilos", "litros", "bultos"]
+
+# Monthly rollups are keyed by these fields and updated with $inc deltas on every write
+KILOS_LITROS_ROLLUP_KEY = ["hub_id", "year", "month", "route_id", "repartidor"]
+_rollup_task = None
+
+def sum_fields(fields: List[str]) -> dict:
+    """$group accumulators summing each field, treating missing values as 0"""
+    return {field: {"$sum": {"$ifNull": [f"${field}", 0]}} for field in fields}
+
+def kilos_litros_rollup_op(hub_id: str, route_id: str, date: str, repartidor: str, new: dict, old: Optional[dict]) -> UpdateOne:
+    """$inc upsert moving a month rollup from the old row values (None if inserted) to the new ones"""
+    old = old or {}
+    deltas = {field: new.get(field, 0) - old.get(field, 0) for field in KILOS_LITROS_FIELDS}
+    if old:
+        deltas["entries"] = 0 if new else -1
+    else:
+        deltas["entries"] = 1
+    return UpdateOne(
+        {
+            "hub_id": hub_id,
+            "year": int(date[:4]),
+            "month": int(date[5:7]),
+            "route_id": route_id,
+            "repartidor": (repartidor or "").lower()
+        },
+        {"$inc": deltas, "$set": {"updated_at": utc_timestamp()}},
+        upsert=True
+    )
+
+async def apply_kilos_litros_rollups(operations: List[UpdateOne]):
+    if operations:
+        await db.kilos_litros_rollups.bulk_write(operations, ordered=False)
+
+async def rebuild_kilos_litros_rollups(hub_id: Optional[str] = None) -> int:
+    """Recompute the month rollups from raw rows, for one hub or all of them. Repairs drift.
+    
+    Rollups are replaced in place rather than emptied first, so $inc writes made
+    during the rebuild are kept; only a write racing the aggregation of its own
+    key can still be off until the next rebuild.
+    """
+    match = {"hub_id": hub_id} if hub_id else {}
+    # $merge needs the unique key index to exist
+    await db.kilos_litros_rollups.create_index(
+        [(field, ASCENDING) for field in KILOS_LITROS_ROLLUP_KEY], name="kilos_litros_rollups_key", unique=True
+    )
+    started_at = utc_timestamp()
+    await merge_kilos_litros_rollups(match, started_at)
+    # Keys with no raw rows left were neither replaced nor written since the rebuild started
+    await db.kilos_litros_rollups.delete_many({**match, "$or": [
+        {"updated_at": {"$lt": started_at}}, {"updated_at": {"$exists": False}}
+    ]})
+    count = await db.kilos_litros_rollups.count_documents(match)
+    logging.info(f"Rollups de kilos/litros reconstruidos: {count} documentos")
+    return count
+
+async def merge_kilos_litros_rollups(match: dict, stamp: str):
+    """Replace the rollups of every key that has raw rows matching match with their recomputed totals"""
+    def to_int(start: int, length: int) -> dict:
+        return {"$convert": {
+            "input": {"$substrBytes": ["$date", start, length]}, "to": "int", "onError": None, "onNull": None
+        }}
+    
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "hub_id": "$hub_id",
+                "year": to_int(0, 4),
+                "month": to_int(5, 2),
+                "route_id": "$route_id",
+                "repartidor": {"$toLower": {"$ifNull": ["$repartidor", ""]}}
+            },
+            "entries": {"$sum": 1},
+            **sum_fields(KILOS_LITROS_FIELDS)
+        }},
+        {"$project": {
+            "_id": 0,
+            **{field: f"$_id.{field}" for field in KILOS_LITROS_ROLLUP_KEY},
+            "entries": 1,
+            **{field: 1 for field in KILOS_LITROS_FIELDS},
+            "updated_at": stamp
+        }},
+        {"$merge": {
+            "into": "kilos_litros_rollups",
+            "on": KILOS_LITROS_ROLLUP_KEY,
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await db.kilos_litros.aggregate(pipeline).to_list(None)
+
+async def ensure_kilos_litros_rollups():
+    """Build the rollups on first start after they were introduced"""
+    if await db.kilos_litros_rollups.find_one({}) is None and await db.kilos_litros.find_one({}) is not None:
+        await rebuild_kilos_litros_rollups()
+
+
+KILOS_LITROS_LIST_PROJECTION = response_projection(KilosLitrosEntryResponse, DATE_SORT)
+
+def kilos_litros_row(e: dict) -> dict:
+    """KilosLitrosEntryResponse fields of a trusted kilos_litros doc"""
+    return {
+        "id": e["id"],
+        "hub_id": e["hub_id"],
+        "route_id": e["route_id"],
+        "date": e["date"],
+        "repartidor": e.get("repartidor", ""),
+        "clientes": int(e.get("clientes", 0)),
+        "kilos": float(e.get("kilos", 0)),
+        "litros": float(e.get("litros", 0)),
+        "bultos": int(e.get("bultos", 0)),
+        "created_at": e["created_at"]
+    }
+
 @api_router.get("/hubs/{hub_id}/kilos-litros")
 async def get_kilos_litros(
     hub_id: str,
     year: int,
     month: int,
     route_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    response_format: str = Query("rows", alias="format"),
+    since: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    columnar = check_response_format(response_format, limit, cursor)
+    
     # Build date range
     start_date = f"{year}-{month:02d}-01"
     last_day = calendar.monthrange(year, month)[1]
@@ -1420,20 +2902,41 @@ async def get_kilos_litros(
     if route_id:
         query["route_id"] = route_id
     
-    entries = await db.kilos_litros.find(query, {"_id": 0}).sort("date", 1).to_list(10000)
-    
-    return [KilosLitrosEntryResponse(
-        id=e["id"],
-        hub_id=e["hub_id"],
-        route_id=e["route_id"],
-        date=e["date"],
-        repartidor=e.get("repartidor", ""),
-        clientes=e.get("clientes", 0),
-        kilos=e.get("kilos", 0),
-        litros=e.get("litros", 0),
-        bultos=e.get("bultos", 0),
-        created_at=e["created_at"]
-    ) for e in entries]
+    if since is not None:
+        paged = columnar or limit is not None or cursor is not None
+        return await changes_since(db.kilos_litros, query, since, kilos_litros_row, KILOS_LITROS_LIST_PROJECTION, paged)
+    if columnar:
+        return await columnar_month(
+            db.kilos_litros, query, DATE_SORT, kilos_litros_row, KILOS_LITROS_LIST_PROJECTION,
+            ["route_id", "repartidor"], {"hub_id": hub_id, "year": year, "month": month, "days_in_month": last_day}
+        )
+    return await paginate(db.kilos_litros, query, DATE_SORT, kilos_litros_row, limit, cursor, total, KILOS_LITROS_LIST_PROJECTION)
+
+async def upsert_kilos_litros(hub_id: str, route_id: str, date: str, repartidor: str, values: dict, now: str) -> tuple:
+    """Atomic upsert of one (route, date, repartidor) row. Returns (previous row or None, row as saved)"""
+    on_insert = {
+        "id": str(uuid.uuid4()),
+        "hub_id": hub_id,
+        "route_id": route_id,
+        "date": date,
+        "repartidor": repartidor,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    arguments = (
+        {"route_id": route_id, "date": date, "repartidor": repartidor},
+        {"$set": {**values, "updated_at": now}, "$setOnInsert": on_insert}
+    )
+    try:
+        previous = await db.kilos_litros.find_one_and_update(
+            *arguments, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert inserted the row first; it exists now, so this one updates it
+        previous = await db.kilos_litros.find_one_and_update(
+            *arguments, projection={"_id": 0}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    entry = {**previous, **values} if previous else {**on_insert, **values}
+    return previous, entry
 
 @api_router.post("/hubs/{hub_id}/kilos-litros", response_model=KilosLitrosEntryResponse)
 async def create_kilos_litros_entry(hub_id: str, entry_data: KilosLitrosEntryCreate, current_user: dict = Depends(get_current_user)):
@@ -1442,43 +2945,27 @@ async def create_kilos_litros_entry(hub_id: str, entry_data: KilosLitrosEntryCre
     if not route:
         raise HTTPException(status_code=404, detail="Ruta no encontrada")
     
+    if not is_valid_date(entry_data.date):
+        raise HTTPException(status_code=400, detail="Fecha inválida, se espera YYYY-MM-DD")
+    
     # Enforce lowercase for repartidor
     repartidor = entry_data.repartidor.lower() if entry_data.repartidor else ""
     
-    # Check if entry already exists for this date, route, and repartidor
-    existing = await db.kilos_litros.find_one({
-        "route_id": entry_data.route_id,
-        "date": entry_data.date,
-        "repartidor": repartidor
-    })
+    values = {
+        "clientes": entry_data.clientes or 0,
+        "kilos": entry_data.kilos or 0,
+        "litros": entry_data.litros or 0,
+        "bultos": entry_data.bultos or 0
+    }
     
-    if existing:
-        # Update existing entry
-        await db.kilos_litros.update_one(
-            {"id": existing["id"]},
-            {"$set": {
-                "clientes": entry_data.clientes or 0,
-                "kilos": entry_data.kilos or 0,
-                "litros": entry_data.litros or 0,
-                "bultos": entry_data.bultos or 0
-            }}
-        )
-        entry = await db.kilos_litros.find_one({"id": existing["id"]}, {"_id": 0})
-    else:
-        # Create new entry
-        entry = {
-            "id": str(uuid.uuid4()),
-            "hub_id": hub_id,
-            "route_id": entry_data.route_id,
-            "date": entry_data.date,
-            "repartidor": repartidor,
-            "clientes": entry_data.clientes or 0,
-            "kilos": entry_data.kilos or 0,
-            "litros": entry_data.litros or 0,
-            "bultos": entry_data.bultos or 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.kilos_litros.insert_one(entry)
+    # Upsert the entry for this date, route, and repartidor, keeping its previous values for the rollup
+    previous, entry = await upsert_kilos_litros(
+        hub_id, entry_data.route_id, entry_data.date, repartidor, values, utc_timestamp()
+    )
+    
+    await apply_kilos_litros_rollups([
+        kilos_litros_rollup_op(entry["hub_id"], entry["route_id"], entry["date"], repartidor, values, previous)
+    ])
     
     return KilosLitrosEntryResponse(
         id=entry["id"],
@@ -1494,50 +2981,91 @@ async def create_kilos_litros_entry(hub_id: str, entry_data: KilosLitrosEntryCre
     )
 
 @api_router.post("/hubs/{hub_id}/kilos-litros/bulk")
-async def save_kilos_litros_bulk(hub_id: str, entries: List[KilosLitrosEntryCreate], current_user: dict = Depends(get_current_user)):
-    saved_count = 0
-    for entry_data in entries:
-        repartidor = entry_data.repartidor.lower() if entry_data.repartidor else ""
+async def save_kilos_litros_bulk(hub_id: str, entries: List[Dict[str, Any]], current_user: dict = Depends(get_current_user)):
+    valid_entries, errors = validate_bulk_entries(entries, KilosLitrosEntryCreate)
+    results = {err["index"]: {"index": err["index"], "status": "error", "error": err["error"]} for err in errors}
+    
+    # Validate each distinct route once
+    route_ids = list({entry.route_id for _, entry in valid_entries})
+    known_routes = await db.routes.find(
+        {"hub_id": hub_id, "id": {"$in": route_ids}}, {"_id": 0, "id": 1}
+    ).to_list(len(route_ids) or 1)
+    known_route_ids = {r["id"] for r in known_routes}
+    
+    # One upsert per (route, date, repartidor); the last entry wins if a row is repeated
+    operations = {}
+    now = utc_timestamp()
+    for index, entry_data in valid_entries:
+        if entry_data.route_id not in known_route_ids:
+            results[index] = {"index": index, "status": "error", "error": "Ruta no encontrada"}
+            continue
         
-        existing = await db.kilos_litros.find_one({
-            "route_id": entry_data.route_id,
-            "date": entry_data.date,
-            "repartidor": repartidor
-        })
+        repartidor = entry_data.repartidor.lower() if entry_data.repartidor else ""
+        key = (entry_data.route_id, entry_data.date, repartidor)
+        if key in operations:
+            superseded_index = operations[key][0]
+            results[superseded_index] = {"index": superseded_index, "status": "duplicate", "replaced_by": index}
         
-        if existing:
-            await db.kilos_litros.update_one(
-                {"id": existing["id"]},
-                {"$set": {
-                    "clientes": entry_data.clientes or 0,
-                    "kilos": entry_data.kilos or 0,
-                    "litros": entry_data.litros or 0,
-                    "bultos": entry_data.bultos or 0
-                }}
-            )
+        values = {
+            "clientes": entry_data.clientes or 0,
+            "kilos": entry_data.kilos or 0,
+            "litros": entry_data.litros or 0,
+            "bultos": entry_data.bultos or 0
+        }
+        operations[key] = (index, values, UpdateOne(
+            {"route_id": entry_data.route_id, "date": entry_data.date, "repartidor": repartidor},
+            {
+                "$set": {**values, "updated_at": now},
+                "$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "hub_id": hub_id,
+                    "route_id": entry_data.route_id,
+                    "date": entry_data.date,
+                    "repartidor": repartidor,
+                    "created_at": datetime.now(timezone.utc).isoformat()
+                }
+            },
+            upsert=True
+        ))
+    
+    keys = list(operations.keys())
+    details, write_errors = await bulk_upsert(db.kilos_litros, [op for _, _, op in operations.values()])
+    upserted_ops = {u["index"] for u in details.get("upserted", [])}
+    for op_index, key in enumerate(keys):
+        index = operations[key][0]
+        if op_index in write_errors:
+            results[index] = {"index": index, "status": "error", "error": write_errors[op_index]}
         else:
-            entry = {
-                "id": str(uuid.uuid4()),
-                "hub_id": hub_id,
-                "route_id": entry_data.route_id,
-                "date": entry_data.date,
-                "repartidor": repartidor,
-                "clientes": entry_data.clientes or 0,
-                "kilos": entry_data.kilos or 0,
-                "litros": entry_data.litros or 0,
-                "bultos": entry_data.bultos or 0,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.kilos_litros.insert_one(entry)
-        saved_count += 1
+            results[index] = {"index": index, "status": "inserted" if op_index in upserted_ops else "updated"}
     
-    return {"message": f"Guardados {saved_count} registros", "count": saved_count}
+    # Recount the touched route months from the raw rows instead of applying deltas
+    # from a separate read of the previous values, which concurrent pastes could skew
+    months = {(route_id, date[:7]) for op_index, (route_id, date, _) in enumerate(keys) if op_index not in write_errors}
+    if months:
+        await merge_kilos_litros_rollups({"$or": [
+            {"route_id": route_id, "date": {"$gte": f"{month}-01", "$lte": f"{month}-31"}}
+            for route_id, month in sorted(months)
+        ]}, now)
+    
+    saved_count = len(operations) - len(write_errors)
+    return {
+        "message": f"Guardados {saved_count} registros",
+        "count": saved_count,
+        "inserted": details.get("nUpserted", 0),
+        "updated": details.get("nMatched", 0),
+        "results": [results[index] for index in sorted(results)]
+    }
 
 @api_router.delete("/hubs/{hub_id}/kilos-litros/{entry_id}")
 async def delete_kilos_litros_entry(hub_id: str, entry_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.kilos_litros.delete_one({"id": entry_id, "hub_id": hub_id})
-    if result.deleted_count == 0:
+    deleted = await db.kilos_litros.find_one_and_delete({"id": entry_id, "hub_id": hub_id}, projection={"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Registro no encontrado")
+    await record_tombstones("kilos_litros", hub_id, [entry_id])
+    if is_valid_date(deleted.get("date")):
+        await apply_kilos_litros_rollups([kilos_litros_rollup_op(
+            hub_id, deleted["route_id"], deleted["date"], deleted.get("repartidor", ""), {}, deleted
+        )])
     return {"message": "Registro eliminado correctamente"}
 
 @api_router.get("/hubs/{hub_id}/kilos-litros/summary")
@@ -1547,77 +3075,76 @@ async def get_kilos_litros_summary(
     month: int,
     current_user: dict = Depends(get_current_user)
 ):
-    start_date = f"{year}-{month:02d}-01"
-    last_day = calendar.monthrange(year, month)[1]
-    end_date = f"{year}-{month:02d}-{last_day}"
-    
     # Get all routes for this hub
     routes = await db.routes.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
     
-    # Get all kilos/litros entries for the month
-    entries = await db.kilos_litros.find({
-        "hub_id": hub_id,
-        "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
-    
-    # Calculate monthly totals
-    total_clientes = sum(e.get("clientes", 0) for e in entries)
-    total_kilos = sum(e.get("kilos", 0) for e in entries)
-    total_litros = sum(e.get("litros", 0) for e in entries)
-    total_bultos = sum(e.get("bultos", 0) for e in entries)
-    
-    # Summary by repartidor
-    repartidor_summary = {}
-    for entry in entries:
-        rep = entry.get("repartidor", "").lower()
-        if rep:
-            if rep not in repartidor_summary:
-                repartidor_summary[rep] = {"clientes": 0, "kilos": 0, "litros": 0, "bultos": 0}
-            repartidor_summary[rep]["clientes"] += entry.get("clientes", 0)
-            repartidor_summary[rep]["kilos"] += entry.get("kilos", 0)
-            repartidor_summary[rep]["litros"] += entry.get("litros", 0)
-            repartidor_summary[rep]["bultos"] += entry.get("bultos", 0)
-    
-    # Summary by route
-    route_summary = []
-    for route in routes:
-        route_entries = [e for e in entries if e.get("route_id") == route["id"]]
-        route_clientes = sum(e.get("clientes", 0) for e in route_entries)
-        route_kilos = sum(e.get("kilos", 0) for e in route_entries)
-        route_litros = sum(e.get("litros", 0) for e in route_entries)
-        route_bultos = sum(e.get("bultos", 0) for e in route_entries)
-        
-        route_summary.append({
-            "route_id": route["id"],
-            "route_name": route["name"],
-            "clientes": route_clientes,
-            "kilos": route_kilos,
-            "litros": route_litros,
-            "bultos": route_bultos
-        })
+    # A handful of pre-aggregated docs: one per (route, repartidor) with entries this month
+    rollups = await db.kilos_litros_rollups.find(
+        {"hub_id": hub_id, "year": year, "month": month, "entries": {"$gt": 0}}, {"_id": 0}
+    ).to_list(None)
     
+    totals = {field: 0 for field in KILOS_LITROS_FIELDS}
+    repartidor_totals = {}
+    route_totals = {}
+    for rollup in rollups:
+        buckets = [totals, route_totals.setdefault(rollup["route_id"], {field: 0 for field in KILOS_LITROS_FIELDS})]
+        if rollup["repartidor"]:
+            buckets.append(repartidor_totals.setdefault(rollup["repartidor"], {field: 0 for field in KILOS_LITROS_FIELDS}))
+        for bucket in buckets:
+            for field in KILOS_LITROS_FIELDS:
+                bucket[field] += rollup.get(field, 0)
+    
+    empty = {field: 0 for field in KILOS_LITROS_FIELDS}
     return {
         "year": year,
         "month": month,
-        "totals": {
-            "clientes": total_clientes,
-            "kilos": total_kilos,
-            "litros": total_litros,
-            "bultos": total_bultos
-        },
+        "totals": totals,
         "by_repartidor": [
-            {
-                "repartidor": rep,
-                "clientes": data["clientes"],
-                "kilos": data["kilos"],
-                "litros": data["litros"],
-                "bultos": data["bultos"]
-            }
-            for rep, data in repartidor_summary.items()
+            {"repartidor": rep, **repartidor_totals[rep]}
+            for rep in sorted(repartidor_totals)
         ],
-        "by_route": route_summary
+        "by_route": [
+            {"route_id": route["id"], "route_name": route["name"], **route_totals.get(route["id"], empty)}
+            for route in routes
+        ]
     }
 
+@api_router.get("/hubs/{hub_id}/kilos-litros/yearly-summary")
+async def get_kilos_litros_yearly_summary(
+    hub_id: str,
+    year: int,
+    current_user: dict = Depends(get_current_user)
+):
+    pipeline = [
+        {"$match": {"hub_id": hub_id, "year": year}},
+        {"$group": {"_id": "$month", **sum_fields(KILOS_LITROS_FIELDS)}}
+    ]
+    month_totals = {m["_id"]: m async for m in db.kilos_litros_rollups.aggregate(pipeline)}
+    
+    months = []
+    for month in range(1, 13):
+        data = month_totals.get(month, {})
+        months.append({"month": month, **{field: data.get(field, 0) for field in KILOS_LITROS_FIELDS}})
+    
+    return {
+        "year": year,
+        "totals": {field: sum(m[field] for m in months) for field in KILOS_LITROS_FIELDS},
+        "months": months
+    }
+
+@api_router.post("/admin/rollups/kilos-litros/rebuild")
+async def rebuild_kilos_litros_rollups_endpoint(hub_id: Optional[str] = None, admin: dict = Depends(get_admin_user)):
+    count = await rebuild_kilos_litros_rollups(hub_id)
+    return {"message": "Rollups de kilos/litros reconstruidos", "count": count}
+
+def liquidation_estado(total: float) -> str:
+    """Human-readable balance for a repartidor"""
+    if total > 0:
+        return f"debe depositar {total:.2f} €"
+    if total < 0:
+        return f"a favor {abs(total):.2f} €"
+    return "sin descuadre"
+
 @api_router.get("/hubs/{hub_id}/liquidations/summary")
 async def get_liquidations_summary(
     hub_id: str,
@@ -1632,54 +3159,63 @@ async def get_liquidations_summary(
     # Get all routes for this hub
     routes = await db.routes.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
     
-    # Get all liquidation entries for the month
-    entries = await db.liquidations.find({
-        "hub_id": hub_id,
-        "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
-    
-    # Summary by repartidor
-    repartidor_summary = {}
-    for entry in entries:
-        rep = entry.get("repartidor", "").lower()
-        if rep:
-            if rep not in repartidor_summary:
-                repartidor_summary[rep] = {"total": 0, "entries": []}
-            diferencia = entry.get("metalico", 0) - entry.get("ingreso", 0)
-            repartidor_summary[rep]["total"] += diferencia
-            if diferencia != 0:
-                repartidor_summary[rep]["entries"].append({
-                    "date": entry["date"],
-                    "route_id": entry["route_id"],
-                    "diferencia": diferencia
-                })
+    # Per-repartidor and per-route totals in a single aggregation; only
+    # non-zero differences are shipped back
+    non_zero = {"$ne": ["$$e.diferencia", 0]}
+    pipeline = [
+        {"$match": {"hub_id": hub_id, "date": {"$gte": start_date, "$lte": end_date}}},
+        {"$project": {
+            "_id": 0,
+            "date": 1,
+            "route_id": 1,
+            "repartidor": {"$ifNull": ["$repartidor", ""]},
+            "metalico": {"$ifNull": ["$metalico", 0]},
+            "ingreso": {"$ifNull": ["$ingreso", 0]},
+            "diferencia": {"$subtract": [{"$ifNull": ["$metalico", 0]}, {"$ifNull": ["$ingreso", 0]}]}
+        }},
+        {"$sort": {"date": 1}},
+        {"$facet": {
+            "by_repartidor": [
+                {"$match": {"repartidor": {"$ne": ""}}},
+                {"$group": {
+                    "_id": {"$toLower": "$repartidor"},
+                    "total": {"$sum": "$diferencia"},
+                    "entries": {"$push": {"date": "$date", "route_id": "$route_id", "diferencia": "$diferencia"}}
+                }},
+                {"$project": {
+                    "total": 1,
+                    "entries": {"$filter": {"input": "$entries", "as": "e", "cond": non_zero}}
+                }},
+                {"$sort": {"_id": 1}}
+            ],
+            "by_route": [
+                {"$group": {
+                    "_id": "$route_id",
+                    "total_metalico": {"$sum": "$metalico"},
+                    "total_ingreso": {"$sum": "$ingreso"},
+                    "descuadres": {"$push": {"date": "$date", "repartidor": "$repartidor", "diferencia": "$diferencia"}}
+                }},
+                {"$project": {
+                    "total_metalico": 1,
+                    "total_ingreso": 1,
+                    "descuadres": {"$filter": {"input": "$descuadres", "as": "e", "cond": non_zero}}
+                }}
+            ]
+        }}
+    ]
+    facets = (await db.liquidations.aggregate(pipeline).to_list(1))[0]
     
-    # Summary by route
+    route_totals = {r["_id"]: r for r in facets["by_route"]}
     route_summary = []
     for route in routes:
-        route_entries = [e for e in entries if e.get("route_id") == route["id"]]
-        total_metalico = sum(e.get("metalico", 0) for e in route_entries)
-        total_ingreso = sum(e.get("ingreso", 0) for e in route_entries)
-        descuadre = total_metalico - total_ingreso
-        
-        # Get descuadres detectados (entries with diferencia != 0)
-        descuadres = []
-        for e in route_entries:
-            dif = e.get("metalico", 0) - e.get("ingreso", 0)
-            if dif != 0:
-                descuadres.append({
-                    "date": e["date"],
-                    "repartidor": e.get("repartidor", ""),
-                    "diferencia": dif
-                })
-        
+        totals = route_totals.get(route["id"], {"total_metalico": 0, "total_ingreso": 0, "descuadres": []})
         route_summary.append({
             "route_id": route["id"],
             "route_name": route["name"],
-            "total_metalico": total_metalico,
-            "total_ingreso": total_ingreso,
-            "descuadre": descuadre,
-            "descuadres_detectados": descuadres
+            "total_metalico": totals["total_metalico"],
+            "total_ingreso": totals["total_ingreso"],
+            "descuadre": totals["total_metalico"] - totals["total_ingreso"],
+            "descuadres_detectados": totals["descuadres"]
         })
     
     return {
@@ -1687,60 +3223,404 @@ async def get_liquidations_summary(
         "month": month,
         "by_repartidor": [
             {
-                "repartidor": rep,
-                "total": data["total"],
-                "estado": f"debe depositar {data['total']:.2f} €" if data["total"] > 0 else f"a favor {abs(data['total']):.2f} €" if data["total"] < 0 else "sin descuadre",
-                "entries": data["entries"]
+                "repartidor": r["_id"],
+                "total": r["total"],
+                "estado": liquidation_estado(r["total"]),
+                "entries": r["entries"]
             }
-            for rep, data in repartidor_summary.items()
+            for r in facets["by_repartidor"]
         ],
         "by_route": route_summary
     }
 
+# ==================== LIQUIDATION LEDGER ====================
+
+# liquidation_ledger holds one doc per (repartidor, year, month, hub) with the
+# month's net difference and a per-day breakdown; liquidation_balances holds the
+# running balance per repartidor. Both are moved with $inc on every liquidation write.
+LEDGER_PROJECTION = {"hub_id": 1, "route_id": 1, "date": 1, "repartidor": 1, "metalico": 1, "ingreso": 1}
+LEDGER_KEY = ["repartidor", "year", "month", "hub_id"]
+_ledger_task = None
+# Serializes rebuilds started by the admin endpoint, the startup migration and dedupe
+ledger_rebuild_lock = asyncio.Lock()
+
+def liquidation_movements(entry: Optional[dict], sign: int) -> List[tuple]:
+    """(repartidor, hub_id, date, amount) contributed by a liquidation row"""
+    if not entry or not entry.get("repartidor") or not is_valid_date(entry.get("date")):
+        return []
+    amount = sign * (entry.get("metalico", 0) - entry.get("ingreso", 0))
+    return [(entry["repartidor"].lower(), entry["hub_id"], entry["date"], amount)]
+
+async def apply_liquidation_ledger(changes: List[tuple]):
+    """Move the ledger from each (old, new) liquidation row pair. None means inserted/deleted."""
+    month_deltas = {}
+    balance_deltas = {}
+    for old, new in changes:
+        for repartidor, hub_id, date, amount in liquidation_movements(old, -1) + liquidation_movements(new, 1):
+            key = (repartidor, int(date[:4]), int(date[5:7]), hub_id)
+            deltas = month_deltas.setdefault(key, {})
+            deltas["net"] = deltas.get("net", 0) + amount
+            deltas[f"days.{date[8:10]}"] = deltas.get(f"days.{date[8:10]}", 0) + amount
+            balance_deltas[repartidor] = balance_deltas.get(repartidor, 0) + amount
+    
+    now = utc_timestamp()
+    ledger_ops = [
+        UpdateOne(
+            {"repartidor": repartidor, "year": year, "month": month, "hub_id": hub_id},
+            {"$inc": deltas, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (repartidor, year, month, hub_id), deltas in month_deltas.items()
+        if any(deltas.values())
+    ]
+    balance_ops = [
+        UpdateOne({"repartidor": repartidor}, {"$inc": {"balance": amount}, "$set": {"updated_at": now}}, upsert=True)
+        for repartidor, amount in balance_deltas.items()
+        if amount
+    ]
+    if ledger_ops:
+        await db.liquidation_ledger.bulk_write(ledger_ops, ordered=False)
+    if balance_ops:
+        await db.liquidation_balances.bulk_write(balance_ops, ordered=False)
+
+async def merge_liquidation_ledger(stamp: str):
+    """Replace every ledger month that has liquidation rows with its recomputed net and days"""
+    def to_int(start: int, length: int) -> dict:
+        return {"$toInt": {"$substrBytes": ["$date", start, length]}}
+    
+    pipeline = [
+        # Same rows liquidation_movements counts: a repartidor and a valid date
+        {"$match": {"repartidor": {"$nin": [None, ""]}, "date": {"$type": "string"}}},
+        {"$match": {"$expr": {"$ne": [
+            {"$dateFromString": {"dateString": "$date", "format": "%Y-%m-%d", "onError": None, "onNull": None}},
+            None
+        ]}}},
+        {"$group": {
+            "_id": {
+                "repartidor": {"$toLower": "$repartidor"},
+                "year": to_int(0, 4),
+                "month": to_int(5, 2),
+                "hub_id": "$hub_id",
+                "day": {"$substrBytes": ["$date", 8, 2]}
+            },
+            "amount": {"$sum": {"$subtract": [{"$ifNull": ["$metalico", 0]}, {"$ifNull": ["$ingreso", 0]}]}}
+        }},
+        {"$group": {
+            "_id": {field: f"$_id.{field}" for field in LEDGER_KEY},
+            "net": {"$sum": "$amount"},
+            "days": {"$push": {"k": "$_id.day", "v": "$amount"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            **{field: f"$_id.{field}" for field in LEDGER_KEY},
+            "net": 1,
+            "days": {"$arrayToObject": "$days"},
+            "updated_at": stamp
+        }},
+        {"$merge": {
+            "into": "liquidation_ledger",
+            "on": LEDGER_KEY,
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await db.liquidations.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+async def merge_liquidation_balances(stamp: str):
+    """Replace every balance with the sum of its repartidor's ledger months"""
+    pipeline = [
+        {"$group": {"_id": "$repartidor", "balance": {"$sum": "$net"}}},
+        {"$project": {"_id": 0, "repartidor": "$_id", "balance": 1, "updated_at": stamp}},
+        {"$merge": {
+            "into": "liquidation_balances",
+            "on": "repartidor",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await db.liquidation_ledger.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+async def rebuild_liquidation_ledger() -> int:
+    """Recompute ledger and balances from the liquidation rows. Repairs drift.
+    
+    Like the kilos/litros rollups, documents are replaced in place rather than
+    emptied first, so readers never see a half-built ledger and $inc writes made
+    during the rebuild are kept. Rebuilds are serialized by ledger_rebuild_lock.
+    """
+    async with ledger_rebuild_lock:
+        # $merge needs the unique key indexes to exist
+        await db.liquidation_ledger.create_index(
+            [(field, ASCENDING) for field in LEDGER_KEY], name="liquidation_ledger_key", unique=True
+        )
+        await db.liquidation_balances.create_index(
+            [("repartidor", ASCENDING)], name="liquidation_balances_repartidor", unique=True
+        )
+        started_at = utc_timestamp()
+        stale = {"$or": [{"updated_at": {"$lt": started_at}}, {"updated_at": {"$exists": False}}]}
+        await merge_liquidation_ledger(started_at)
+        # Months with no rows left were neither replaced nor written since the rebuild started
+        await db.liquidation_ledger.delete_many(stale)
+        await merge_liquidation_balances(started_at)
+        await db.liquidation_balances.delete_many(stale)
+        count = await db.liquidation_ledger.count_documents({})
+    logging.info(f"Libro de liquidaciones reconstruido: {count} meses")
+    return count
+
+async def ensure_liquidation_ledger():
+    """Build the ledger once, on the first start after it was introduced.
+    
+    Completion is recorded in db.migrations: an empty ledger is not proof that it
+    was never built, since rows that net to zero leave no balance documents.
+    """
+    name = "liquidation_ledger"
+    migration = await db.migrations.find_one({"name": name}, {"_id": 0, "state": 1})
+    if migration and migration.get("state") == "done":
+        return
+    if migration is None and await db.liquidation_balances.find_one({}) is not None:
+        # Built before completion was recorded
+        await db.migrations.update_one(
+            {"name": name},
+            {"$set": {"state": "done", "finished_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        return
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "running", "started_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    processed = await rebuild_liquidation_ledger()
+    await db.migrations.update_one(
+        {"name": name},
+        {"$set": {"state": "done", "processed": processed, "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def ledger_balances_as_of(as_of: str, repartidor: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    """Balance and year-to-date net per repartidor at the end of the given day"""
+    year, month, day = int(as_of[:4]), int(as_of[5:7]), as_of[8:10]
+    match = {"$or": [{"year": {"$lt": year}}, {"year": year, "month": {"$lt": month}}]}
+    if repartidor:
+        match["repartidor"] = repartidor
+    
+    # Whole months before as_of come from the monthly nets
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$repartidor",
+            "balance": {"$sum": "$net"},
+            "ytd": {"$sum": {"$cond": [{"$eq": ["$year", year]}, "$net", 0]}}
+        }}
+    ]
+    balances = {
+        b["_id"]: {"balance": b["balance"], "ytd": b["ytd"]}
+        async for b in db.liquidation_ledger.aggregate(pipeline)
+    }
+    
+    # The month of as_of is added day by day up to and including as_of
+    current = {"year": year, "month": month}
+    if repartidor:
+        current["repartidor"] = repartidor
+    async for doc in db.liquidation_ledger.find(current, {"_id": 0, "repartidor": 1, "days": 1}):
+        amount = sum(v for d, v in doc.get("days", {}).items() if d <= day)
+        totals = balances.setdefault(doc["repartidor"], {"balance": 0, "ytd": 0})
+        totals["balance"] += amount
+        totals["ytd"] += amount
+    return balances
+
+@api_router.get("/liquidations/ledger/balances")
+async def get_ledger_balances(
+    as_of: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if as_of:
+        if not is_valid_date(as_of):
+            raise HTTPException(status_code=400, detail="Fecha inválida, se espera YYYY-MM-DD")
+        balances = await ledger_balances_as_of(as_of)
+    else:
+        # Current balances are read straight from the running totals
+        year = datetime.now(timezone.utc).year
+        pipeline = [
+            {"$match": {"year": year}},
+            {"$group": {"_id": "$repartidor", "ytd": {"$sum": "$net"}}}
+        ]
+        ytd = {y["_id"]: y["ytd"] async for y in db.liquidation_ledger.aggregate(pipeline)}
+        balances = {
+            b["repartidor"]: {"balance": b.get("balance", 0), "ytd": ytd.get(b["repartidor"], 0)}
+            async for b in db.liquidation_balances.find({}, {"_id": 0})
+        }
+    
+    return {
+        "as_of": as_of,
+        "balances": [
+            {
+                "repartidor": rep,
+                "balance": data["balance"],
+                "year_to_date": data["ytd"],
+                "estado": liquidation_estado(data["balance"])
+            }
+            for rep, data in sorted(balances.items())
+        ]
+    }
+
+@api_router.get("/liquidations/ledger/{repartidor}/statement")
+async def get_ledger_statement(
+    repartidor: str,
+    date_from: str,
+    date_to: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    repartidor = repartidor.lower()
+    date_to = date_to or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if not is_valid_date(date_from) or not is_valid_date(date_to) or date_from > date_to:
+        raise HTTPException(status_code=400, detail="Rango de fechas inválido, se espera YYYY-MM-DD")
+    
+    day_before = (datetime.strptime(date_from, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    opening = (await ledger_balances_as_of(day_before, repartidor)).get(repartidor, {"balance": 0})["balance"]
+    
+    # Only the month docs inside the range are read
+    from_year, from_month = int(date_from[:4]), int(date_from[5:7])
+    to_year, to_month = int(date_to[:4]), int(date_to[5:7])
+    months = await db.liquidation_ledger.find({
+        "repartidor": repartidor,
+        "$and": [
+            {"$or": [{"year": {"$gt": from_year}}, {"year": from_year, "month": {"$gte": from_month}}]},
+            {"$or": [{"year": {"$lt": to_year}}, {"year": to_year, "month": {"$lte": to_month}}]}
+        ]
+    }, {"_id": 0}).to_list(None)
+    
+    hubs = await db.hubs.find({"id": {"$in": list({m["hub_id"] for m in months})}}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+    hub_names = {h["id"]: h["name"] for h in hubs}
+    
+    movements = []
+    for doc in months:
+        for day, amount in doc.get("days", {}).items():
+            date = f"{doc['year']}-{doc['month']:02d}-{day}"
+            if amount and date_from <= date <= date_to:
+                movements.append({
+                    "date": date,
+                    "hub_id": doc["hub_id"],
+                    "hub_name": hub_names.get(doc["hub_id"], ""),
+                    "amount": amount
+                })
+    movements.sort(key=lambda m: (m["date"], m["hub_name"]))
+    
+    balance = opening
+    for movement in movements:
+        balance += movement["amount"]
+        movement["balance"] = balance
+    
+    return {
+        "repartidor": repartidor,
+        "date_from": date_from,
+        "date_to": date_to,
+        "opening_balance": opening,
+        "closing_balance": balance,
+        "estado": liquidation_estado(balance),
+        "movements": movements
+    }
+
+@api_router.post("/admin/ledger/liquidations/rebuild")
+async def rebuild_liquidation_ledger_endpoint(admin: dict = Depends(get_admin_user)):
+    count = await rebuild_liquidation_ledger()
+    return {"message": "Libro de liquidaciones reconstruido", "count": count}
+
 # ==================== HOLIDAYS (DÍAS FESTIVOS) ROUTES ====================
 
-# Default national holidays for Spain 2026
-NATIONAL_HOLIDAYS_2026 = [
-    {"date": "2026-01-01", "name": "Año Nuevo", "type": "nacional"},
-    {"date": "2026-01-06", "name": "Epifanía del Señor", "type": "nacional"},
-    {"date": "2026-04-02", "name": "Jueves Santo", "type": "nacional"},
-    {"date": "2026-04-03", "name": "Viernes Santo", "type": "nacional"},
-    {"date": "2026-05-01", "name": "Día del Trabajador", "type": "nacional"},
-    {"date": "2026-08-15", "name": "Asunción de la Virgen", "type": "nacional"},
-    {"date": "2026-10-12", "name": "Fiesta Nacional de España", "type": "nacional"},
-    {"date": "2026-11-01", "name": "Todos los Santos", "type": "nacional"},
-    {"date": "2026-12-06", "name": "Día de la Constitución", "type": "nacional"},
-    {"date": "2026-12-08", "name": "Inmaculada Concepción", "type": "nacional"},
-    {"date": "2026-12-25", "name": "Navidad", "type": "nacional"},
+# Holiday rules. A rule is either a fixed day of the year ("month"/"day") or an
+# offset in days from Easter Sunday ("easter"), so presets exist for any year.
+NATIONAL_HOLIDAY_RULES = [
+    {"month": 1, "day": 1, "name": "Año Nuevo"},
+    {"month": 1, "day": 6, "name": "Epifanía del Señor"},
+    {"easter": -3, "name": "Jueves Santo"},
+    {"easter": -2, "name": "Viernes Santo"},
+    {"month": 5, "day": 1, "name": "Día del Trabajador"},
+    {"month": 8, "day": 15, "name": "Asunción de la Virgen"},
+    {"month": 10, "day": 12, "name": "Fiesta Nacional de España"},
+    {"month": 11, "day": 1, "name": "Todos los Santos"},
+    {"month": 12, "day": 6, "name": "Día de la Constitución"},
+    {"month": 12, "day": 8, "name": "Inmaculada Concepción"},
+    {"month": 12, "day": 25, "name": "Navidad"},
 ]
 
-# Local holidays by location
-LOCAL_HOLIDAYS_2026 = {
+# Regional (autonómico) rules by region, and the region of each location
+REGIONAL_HOLIDAY_RULES = {
     "madrid": [
-        {"date": "2026-03-19", "name": "San José", "type": "autonomico"},
-        {"date": "2026-05-02", "name": "Día de la Comunidad de Madrid", "type": "autonomico"},
-        {"date": "2026-05-15", "name": "San Isidro", "type": "local"},
-        {"date": "2026-11-09", "name": "Nuestra Señora de la Almudena", "type": "local"},
+        {"month": 3, "day": 19, "name": "San José"},
+        {"month": 5, "day": 2, "name": "Día de la Comunidad de Madrid"},
+    ],
+    "extremadura": [
+        {"month": 2, "day": 28, "name": "Día de Extremadura"},
+    ],
+    "andalucia": [
+        {"month": 2, "day": 28, "name": "Día de Andalucía"},
+    ],
+    "murcia": [
+        {"month": 6, "day": 9, "name": "Día de la Región de Murcia"},
+    ],
+}
+
+LOCATION_REGIONS = {
+    "madrid": "madrid",
+    "caceres": "extremadura",
+    "cordoba": "andalucia",
+    "cartagena": "murcia",
+    "cadiz": "andalucia",
+}
+
+LOCAL_HOLIDAY_RULES = {
+    "madrid": [
+        {"month": 5, "day": 15, "name": "San Isidro"},
+        {"month": 11, "day": 9, "name": "Nuestra Señora de la Almudena"},
     ],
     "caceres": [
-        {"date": "2026-02-28", "name": "Día de Extremadura", "type": "autonomico"},
-        {"date": "2026-04-23", "name": "San Jorge", "type": "local"},
+        {"month": 4, "day": 23, "name": "San Jorge"},
     ],
     "cordoba": [
-        {"date": "2026-02-28", "name": "Día de Andalucía", "type": "autonomico"},
-        {"date": "2026-05-24", "name": "San Rafael", "type": "local"},
-        {"date": "2026-10-24", "name": "San Rafael", "type": "local"},
+        {"month": 5, "day": 24, "name": "San Rafael"},
+        {"month": 10, "day": 24, "name": "San Rafael"},
     ],
     "cartagena": [
-        {"date": "2026-06-09", "name": "Día de la Región de Murcia", "type": "autonomico"},
-        {"date": "2026-07-16", "name": "Virgen del Carmen", "type": "local"},
+        {"month": 7, "day": 16, "name": "Virgen del Carmen"},
     ],
     "cadiz": [
-        {"date": "2026-02-28", "name": "Día de Andalucía", "type": "autonomico"},
-        {"date": "2026-10-07", "name": "Nuestra Señora del Rosario", "type": "local"},
+        {"month": 10, "day": 7, "name": "Nuestra Señora del Rosario"},
     ],
 }
 
+def easter_sunday(year: int) -> datetime:
+    """Gregorian Easter Sunday (anonymous Gregorian computus)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime(year, month, day + 1)
+
+def holiday_rule_date(rule: dict, year: int) -> str:
+    if "easter" in rule:
+        return (easter_sunday(year) + timedelta(days=rule["easter"])).strftime("%Y-%m-%d")
+    return f"{year}-{rule['month']:02d}-{rule['day']:02d}"
+
+@lru_cache(maxsize=256)
+def preset_holidays(location_key: str, year: int) -> tuple:
+    """National, regional and local presets for a location and year, memoised"""
+    rule_sets = [
+        ("nat", "nacional", NATIONAL_HOLIDAY_RULES),
+        ("loc", "autonomico", REGIONAL_HOLIDAY_RULES.get(LOCATION_REGIONS.get(location_key), [])),
+        ("loc", "local", LOCAL_HOLIDAY_RULES.get(location_key, [])),
+    ]
+    holidays = []
+    for prefix, holiday_type, rules in rule_sets:
+        for rule in rules:
+            date = holiday_rule_date(rule, year)
+            holidays.append({"id": f"{prefix}_{date}", "date": date, "name": rule["name"], "type": holiday_type})
+    return tuple(sorted(holidays, key=lambda h: h["date"]))
+
 def get_location_key(hub_name: str) -> str:
     """Map hub name to location key for holidays"""
     name_lower = hub_name.lower()
@@ -1756,53 +3636,46 @@ def get_location_key(hub_name: str) -> str:
         return "cadiz"
     return "madrid"  # default
 
+async def hub_location_key(hub: dict) -> str:
+    """Location key stored on the hub; hubs created before it existed get it derived once and saved"""
+    if hub.get("location_key"):
+        return hub["location_key"]
+    location_key = get_location_key(f"{hub.get('location', '')} {hub.get('name', '')}")
+    await db.hubs.update_one({"id": hub["id"]}, {"$set": {"location_key": location_key}})
+    return location_key
+
+HOLIDAY_RULES_HASH = content_hash([NATIONAL_HOLIDAY_RULES, REGIONAL_HOLIDAY_RULES, LOCATION_REGIONS, LOCAL_HOLIDAY_RULES])
+
 @api_router.get("/hubs/{hub_id}/holidays")
 async def get_holidays(
     hub_id: str,
     year: int,
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
+    # Presets come from code, so a deploy that changes the rules also changes the ETag
+    etag = resource_etag(hub_id, "hubs", "holidays", suffix=HOLIDAY_RULES_HASH)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
     # Get hub to determine location
     hub = await db.hubs.find_one({"id": hub_id}, {"_id": 0})
     if not hub:
         raise HTTPException(status_code=404, detail="Hub no encontrado")
     
-    location_key = get_location_key(hub.get("name", ""))
+    location_key = await hub_location_key(hub)
     
-    # Get custom holidays from database
+    # Get custom holidays from database (range query on the (hub_id, date) index)
     custom_holidays = await db.holidays.find({
         "hub_id": hub_id,
-        "date": {"$regex": f"^{year}-"}
+        "date": {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}
     }, {"_id": 0}).to_list(500)
     
-    # Build response with national + local + custom holidays
-    all_holidays = []
-    
-    # National holidays (if year matches)
-    if year == 2026:
-        for h in NATIONAL_HOLIDAYS_2026:
-            all_holidays.append({
-                "id": f"nat_{h['date']}",
-                "hub_id": hub_id,
-                "date": h["date"],
-                "name": h["name"],
-                "type": h["type"],
-                "is_preset": True,
-                "created_at": ""
-            })
-        
-        # Local holidays for this location
-        local_holidays = LOCAL_HOLIDAYS_2026.get(location_key, [])
-        for h in local_holidays:
-            all_holidays.append({
-                "id": f"loc_{h['date']}",
-                "hub_id": hub_id,
-                "date": h["date"],
-                "name": h["name"],
-                "type": h["type"],
-                "is_preset": True,
-                "created_at": ""
-            })
+    # Build response with national + regional + local + custom holidays
+    all_holidays = [
+        {**h, "hub_id": hub_id, "is_preset": True, "created_at": ""}
+        for h in preset_holidays(location_key, year)
+    ]
     
     # Add custom holidays
     for h in custom_holidays:
@@ -1819,12 +3692,12 @@ async def get_holidays(
     # Sort by date
     all_holidays.sort(key=lambda x: x["date"])
     
-    return {
+    return cacheable({
         "year": year,
         "hub_id": hub_id,
         "location": location_key,
         "holidays": all_holidays
-    }
+    }, etag)
 
 @api_router.post("/hubs/{hub_id}/holidays", response_model=HolidayResponse)
 async def create_holiday(hub_id: str, holiday_data: HolidayCreate, current_user: dict = Depends(get_current_user)):
@@ -1849,6 +3722,8 @@ async def create_holiday(hub_id: str, holiday_data: HolidayCreate, current_user:
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.holidays.insert_one(holiday)
+    invalidate_working_calendars(hub_id)
+    await bump_version("holidays", hub_id)
     
     return HolidayResponse(
         id=holiday["id"],
@@ -1872,6 +3747,8 @@ async def update_holiday(hub_id: str, holiday_id: str, holiday_data: HolidayUpda
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Festivo no encontrado")
+    invalidate_working_calendars(hub_id)
+    await bump_version("holidays", hub_id)
     
     holiday = await db.holidays.find_one({"id": holiday_id}, {"_id": 0})
     return HolidayResponse(
@@ -1888,10 +3765,302 @@ async def delete_holiday(hub_id: str, holiday_id: str, current_user: dict = Depe
     result = await db.holidays.delete_one({"id": holiday_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Festivo no encontrado o es un festivo predefinido")
+    invalidate_working_calendars(hub_id)
+    await bump_version("holidays", hub_id)
     return {"message": "Festivo eliminado correctamente"}
 
+# ==================== WORKING CALENDAR ====================
+
+WORKING_CALENDAR_CACHE_SIZE = int(os.environ.get("WORKING_CALENDAR_CACHE_SIZE", "2000"))
+
+# (hub_id, year, month, holidays version, hubs version) -> calendar. Keying on the
+# resource versions makes other processes miss once their versions refresh;
+# this process also drops the hub's entries right away.
+working_calendars = OrderedDict()
+
+def invalidate_working_calendars(hub_id: str):
+    for key in [k for k in working_calendars if k[0] == hub_id]:
+        del working_calendars[key]
+
+async def working_calendar(hub_id: str, year: int, month: int, hub: Optional[dict] = None) -> dict:
+    """Working days of a hub month: weekdays that are not preset or custom holidays"""
+    key = (
+        hub_id, year, month,
+        resource_versions.get(("holidays", hub_id), 0),
+        resource_versions.get(("hubs", hub_id), 0)
+    )
+    cached = working_calendars.get(key)
+    if cached is not None:
+        working_calendars.move_to_end(key)
+        return cached
+    
+    if hub is None:
+        hub = await db.hubs.find_one({"id": hub_id}, {"_id": 0})
+        if not hub:
+            raise HTTPException(status_code=404, detail="Hub no encontrado")
+    location_key = await hub_location_key(hub)
+    
+    month_prefix = f"{year}-{month:02d}-"
+    last_day = calendar.monthrange(year, month)[1]
+    holidays = {h["date"]: h["name"] for h in preset_holidays(location_key, year) if h["date"].startswith(month_prefix)}
+    custom_holidays = await db.holidays.find({
+        "hub_id": hub_id,
+        "date": {"$gte": f"{month_prefix}01", "$lte": f"{month_prefix}{last_day:02d}"}
+    }, {"_id": 0, "date": 1, "name": 1}).to_list(100)
+    for h in custom_holidays:
+        holidays.setdefault(h["date"], h["name"])
+    
+    working_dates, weekend_dates = [], []
+    for day in range(1, last_day + 1):
+        date = f"{month_prefix}{day:02d}"
+        if calendar.weekday(year, month, day) >= 5:
+            weekend_dates.append(date)
+        elif date not in holidays:
+            working_dates.append(date)
+    
+    cal = {
+        "hub_id": hub_id,
+        "year": year,
+        "month": month,
+        "days_in_month": last_day,
+        "working_days": len(working_dates),
+        "working_dates": working_dates,
+        "weekend_dates": weekend_dates,
+        # Holidays that fall on a weekday, i.e. the ones that remove a working day
+        "holidays": [{"date": d, "name": holidays[d]} for d in sorted(holidays) if d not in weekend_dates]
+    }
+    working_calendars[key] = cal
+    while len(working_calendars) > WORKING_CALENDAR_CACHE_SIZE:
+        working_calendars.popitem(last=False)
+    return cal
+
+@api_router.get("/hubs/{hub_id}/working-calendar")
+async def get_working_calendar(
+    hub_id: str,
+    year: int,
+    month: Optional[int] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    hub = await db.hubs.find_one({"id": hub_id}, {"_id": 0})
+    if not hub:
+        raise HTTPException(status_code=404, detail="Hub no encontrado")
+    if month is not None and not 1 <= month <= 12:
+        raise HTTPException(status_code=400, detail="Mes no válido")
+    
+    months = [month] if month else range(1, 13)
+    calendars = [await working_calendar(hub_id, year, m, hub) for m in months]
+    return {
+        "hub_id": hub_id,
+        "year": year,
+        "working_days": sum(c["working_days"] for c in calendars),
+        "months": calendars
+    }
+
+@api_router.get("/working-calendar")
+async def get_working_calendar_overview(year: int, current_user: dict = Depends(get_current_user)):
+    """Working days per hub and month for a whole year, served from the cached calendars"""
+    hubs = await db.hubs.find({}, {"_id": 0}).to_list(100)
+    overview = []
+    for hub in hubs:
+        calendars = [await working_calendar(hub["id"], year, m, hub) for m in range(1, 13)]
+        overview.append({
+            "hub_id": hub["id"],
+            "hub_name": hub["name"],
+            "working_days": sum(c["working_days"] for c in calendars),
+            "by_month": [c["working_days"] for c in calendars]
+        })
+    return {"year": year, "hubs": overview}
+
 # ==================== TIME RESTRICTIONS (RESTRICCIONES HORARIAS) ROUTES ====================
 
+# Restriction schedules are local times of the hubs
+RESTRICTIONS_TIMEZONE = ZoneInfo(os.environ.get('RESTRICTIONS_TIMEZONE', 'Europe/Madrid'))
+RESTRICTION_TABLE_TTL_SECONDS = float(os.environ.get('RESTRICTION_TABLE_TTL_SECONDS', '60'))
+# vehicle_type values that count as zero-emission (vehiculos_0); everything else is vehiculos_combustible
+ZERO_EMISSION_VEHICLE_TYPES = {
+    t.strip().casefold() for t in os.environ.get('ZERO_EMISSION_VEHICLE_TYPES', '').split(',') if t.strip()
+}
+
+VEHICLE_CLASSES = ["vehiculos_0", "vehiculos_combustible"]
+WEEKDAY_LETTERS = "LMXJVSD"  # bit i of days_mask is WEEKDAY_LETTERS[i], Monday first
+WEEKDAY_NAMES = {
+    "LUNES": "L", "MARTES": "M", "MIERCOLES": "X", "JUEVES": "J",
+    "VIERNES": "V", "SABADO": "S", "DOMINGO": "D"
+}
+ALL_DAYS_MASK = (1 << 7) - 1
+TIME_RANGE_RE = re.compile(r"^(\d{1,2})(?:[:.](\d{2}))?\s*H?\s*(?:-|–|A)\s*(\d{1,2})(?:[:.](\d{2}))?\s*H?$")
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn")
+
+def normalize_zone(zona: str) -> str:
+    return " ".join(strip_accents(zona).casefold().split())
+
+def parse_clock(hours: str, minutes: Optional[str]) -> int:
+    h, m = int(hours), int(minutes or 0)
+    if h < 0 or m < 0 or h > 24 or m > 59 or (h == 24 and m):
+        raise ValueError(f"hora fuera de rango: {hours}:{minutes or '00'}")
+    return h * 60 + m
+
+def parse_horario(horario: str) -> List[List[int]]:
+    """'7:00 - 10:00 y 18:00 - 21:00' -> [[420, 600], [1080, 1260]] (minutes from midnight).
+    
+    An interval whose end is before its start runs past midnight into the next day.
+    """
+    text = " ".join(strip_accents(horario).upper().split())
+    if text in ("24H", "24 H", "24 HORAS", "TODO EL DIA"):
+        return [[0, 1440]]
+    intervals = []
+    for part in re.split(r"\s+Y\s+|[,;/]", text):
+        part = part.strip()
+        match = TIME_RANGE_RE.match(part)
+        if not match:
+            raise ValueError(f"tramo no reconocido: '{part}'")
+        start = parse_clock(match.group(1), match.group(2))
+        end = parse_clock(match.group(3), match.group(4))
+        if start == end or start == 1440:
+            raise ValueError(f"tramo vacío: '{part}'")
+        intervals.append([start, end])
+    return intervals
+
+def parse_dias(dias: str) -> int:
+    """'L-V' / 'L,X,V' / 'Lunes a Viernes' / 'Todos' -> weekday bitmask (bit 0 = Monday)"""
+    text = " ".join(strip_accents(dias).upper().split())
+    if text in ("TODOS", "TODOS LOS DIAS", "DIARIO", "L-D"):
+        return ALL_DAYS_MASK
+    for name, letter in WEEKDAY_NAMES.items():
+        text = text.replace(name, letter)
+    text = re.sub(r"\s*(?:-|\bA\b)\s*", "-", text)
+    mask = 0
+    for token in re.split(r"[,;/\s]+|\bY\b", text):
+        if not token:
+            continue
+        first, _, last = token.partition("-")
+        if first not in WEEKDAY_LETTERS or len(first) != 1 or (last and (last not in WEEKDAY_LETTERS or len(last) != 1)):
+            raise ValueError(f"días no reconocidos: '{token}'")
+        i = WEEKDAY_LETTERS.index(first)
+        j = WEEKDAY_LETTERS.index(last) if last else i
+        while True:
+            mask |= 1 << i
+            if i == j:
+                break
+            i = (i + 1) % 7
+    if not mask:
+        raise ValueError("no se indicó ningún día")
+    return mask
+
+def parse_restriction_schedule(horario: str, dias: str) -> dict:
+    """Normalized schedule stored with each restriction; 400 on unparseable text"""
+    try:
+        return {"intervals": parse_horario(horario), "days_mask": parse_dias(dias)}
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Horario o días no válidos ({e}). Formato esperado: '7:00 - 10:00 y 18:00 - 21:00' y 'L-V'"
+        )
+
+class RestrictionTable:
+    """Restricted zones of one hub per (vehicle class, weekday) as sorted minute segments.
+    
+    bounds[c][d] holds the segment start minutes; zones[c][d][i] the restrictions active
+    from bounds[c][d][i] until the next bound, so a lookup is one bisect.
+    """
+    
+    def __init__(self, restrictions: List[dict]):
+        self.built_at = time.monotonic()
+        self.restrictions = restrictions
+        self.bounds = {c: [[0] for _ in range(7)] for c in VEHICLE_CLASSES}
+        self.zones = {c: [[()] for _ in range(7)] for c in VEHICLE_CLASSES}
+        
+        pieces = {c: [[] for _ in range(7)] for c in VEHICLE_CLASSES}
+        for r in restrictions:
+            classes = VEHICLE_CLASSES if r["aplica_a"] == "todos" else [r["aplica_a"]]
+            for day in range(7):
+                if not r["days_mask"] & (1 << day):
+                    continue
+                for start, end in r["intervals"]:
+                    if start < end:
+                        spans = [(day, start, end)]
+                    else:
+                        # Past midnight: the tail belongs to the next weekday
+                        spans = [(day, start, 1440), ((day + 1) % 7, 0, end)]
+                    for c in classes:
+                        for d, s, e in spans:
+                            pieces[c][d].append((s, e, r))
+        
+        for c in VEHICLE_CLASSES:
+            for d in range(7):
+                if not pieces[c][d]:
+                    continue
+                bounds = sorted({0, 1440} | {s for s, _, _ in pieces[c][d]} | {e for _, e, _ in pieces[c][d]})
+                self.bounds[c][d] = bounds[:-1]
+                self.zones[c][d] = [
+                    tuple(r for s, e, r in pieces[c][d] if s <= b < e)
+                    for b in bounds[:-1]
+                ]
+    
+    def restricted_at(self, vehicle_class: str, weekday: int, minute: int) -> tuple:
+        i = bisect_right(self.bounds[vehicle_class][weekday], minute) - 1
+        return self.zones[vehicle_class][weekday][i]
+    
+    def restricted_during(self, vehicle_class: str, weekday: int, start: int, end: int) -> List[dict]:
+        """Restrictions active at any minute of [start, end) on a weekday"""
+        bounds = self.bounds[vehicle_class][weekday]
+        zones = self.zones[vehicle_class][weekday]
+        found = {}
+        i = bisect_right(bounds, start) - 1
+        while i < len(bounds) and bounds[i] < end:
+            for r in zones[i]:
+                found[r["id"]] = r
+            i += 1
+        return list(found.values())
+
+def vehicle_class_for(vehicle_type: str) -> str:
+    return "vehiculos_0" if vehicle_type.casefold() in ZERO_EMISSION_VEHICLE_TYPES else "vehiculos_combustible"
+
+# hub_id -> RestrictionTable, rebuilt after writes to the hub's restrictions or when stale
+restriction_tables: Dict[str, RestrictionTable] = {}
+
+def invalidate_restriction_table(hub_id: str):
+    restriction_tables.pop(hub_id, None)
+
+async def restriction_table(hub_id: str) -> RestrictionTable:
+    table = restriction_tables.get(hub_id)
+    if table and time.monotonic() - table.built_at < RESTRICTION_TABLE_TTL_SECONDS:
+        return table
+    
+    restrictions = []
+    async for r in db.time_restrictions.find({"hub_id": hub_id}, {"_id": 0}):
+        if "intervals" not in r or "days_mask" not in r:
+            # Saved before schedules were parsed on write; backfill the ones that parse
+            try:
+                schedule = {"intervals": parse_horario(r["horario"]), "days_mask": parse_dias(r.get("dias", "L-V"))}
+            except ValueError:
+                logging.warning(f"Restricción {r['id']} con horario no interpretable: {r['horario']!r} / {r.get('dias')!r}")
+                continue
+            await db.time_restrictions.update_one({"id": r["id"]}, {"$set": schedule})
+            r.update(schedule)
+        restrictions.append(r)
+    
+    table = RestrictionTable(restrictions)
+    restriction_tables[hub_id] = table
+    return table
+
+def restriction_local_time(at: Optional[str]) -> datetime:
+    """Parse an ISO timestamp (naive means hub local time); now when missing"""
+    if not at:
+        return datetime.now(RESTRICTIONS_TIMEZONE)
+    try:
+        moment = datetime.fromisoformat(at)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha y hora no válidas, use formato ISO (YYYY-MM-DDTHH:MM)")
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=RESTRICTIONS_TIMEZONE)
+    return moment.astimezone(RESTRICTIONS_TIMEZONE)
+
+def restriction_summary(r: dict) -> dict:
+    return {"id": r["id"], "zona": r["zona"], "horario": r["horario"], "dias": r.get("dias", "L-V"), "aplica_a": r["aplica_a"]}
+
 @api_router.get("/hubs/{hub_id}/time-restrictions")
 async def get_time_restrictions(hub_id: str, current_user: dict = Depends(get_current_user)):
     restrictions = await db.time_restrictions.find({"hub_id": hub_id}, {"_id": 0}).to_list(500)
@@ -1906,6 +4075,110 @@ async def get_time_restrictions(hub_id: str, current_user: dict = Depends(get_cu
         created_at=r.get("created_at", "")
     ) for r in restrictions]
 
+@api_router.get("/hubs/{hub_id}/time-restrictions/check")
+async def check_time_restrictions(
+    hub_id: str,
+    vehicle_class: str,
+    at: Optional[str] = None,
+    zona: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Zones restricted for a vehicle class at a moment (default now)"""
+    if vehicle_class not in VEHICLE_CLASSES:
+        raise HTTPException(status_code=400, detail=f"vehicle_class debe ser uno de: {VEHICLE_CLASSES}")
+    
+    moment = restriction_local_time(at)
+    table = await restriction_table(hub_id)
+    minute = moment.hour * 60 + moment.minute
+    restricted = table.restricted_at(vehicle_class, moment.weekday(), minute)
+    
+    response = {
+        "hub_id": hub_id,
+        "vehicle_class": vehicle_class,
+        "at": moment.isoformat(),
+        "restricted_zones": [restriction_summary(r) for r in restricted]
+    }
+    if zona is not None:
+        response["zona"] = zona
+        response["allowed"] = not any(normalize_zone(r["zona"]) == normalize_zone(zona) for r in restricted)
+    return response
+
+@api_router.post("/hubs/{hub_id}/time-restrictions/validate")
+async def validate_delivery_schedule(
+    hub_id: str,
+    plan: ScheduleValidationRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Check a day of planned deliveries against the hub's restrictions in one pass"""
+    if not is_valid_date(plan.date):
+        raise HTTPException(status_code=400, detail="Fecha no válida, use formato YYYY-MM-DD")
+    weekday = datetime.strptime(plan.date, "%Y-%m-%d").weekday()
+    
+    table = await restriction_table(hub_id)
+    plates = {d.plate.strip().upper() for d in plan.deliveries}
+    vehicle_types = {
+        v["plate"]: v["vehicle_type"]
+        async for v in db.vehicles.find(
+            {"hub_id": hub_id, "plate": {"$in": list(plates)}}, {"_id": 0, "plate": 1, "vehicle_type": 1}
+        )
+    }
+    
+    violations = []
+    errors = []
+    for index, delivery in enumerate(plan.deliveries):
+        plate = delivery.plate.strip().upper()
+        vehicle_class = delivery.vehicle_class
+        if vehicle_class is None:
+            if plate not in vehicle_types:
+                errors.append({"index": index, "error": f"Matrícula no encontrada: {plate}"})
+                continue
+            vehicle_class = vehicle_class_for(vehicle_types[plate])
+        elif vehicle_class not in VEHICLE_CLASSES:
+            errors.append({"index": index, "error": f"vehicle_class debe ser uno de: {VEHICLE_CLASSES}"})
+            continue
+        
+        try:
+            start = parse_clock(*delivery.start.strip().split(":"))
+            end = parse_clock(*delivery.end.strip().split(":"))
+        except (TypeError, ValueError):
+            errors.append({"index": index, "error": "Ventana horaria no válida, use formato HH:MM"})
+            continue
+        # Same rule as parse_horario: an empty window would otherwise be read as a full day
+        if start == end or start == 1440:
+            errors.append({"index": index, "error": "Ventana horaria vacía"})
+            continue
+        
+        if start < end:
+            spans = [(weekday, start, end)]
+        else:
+            spans = [(weekday, start, 1440), ((weekday + 1) % 7, 0, end)]
+        zone = normalize_zone(delivery.zona)
+        hits = [
+            r for d, s, e in spans
+            for r in table.restricted_during(vehicle_class, d, s, e)
+            if normalize_zone(r["zona"]) == zone
+        ]
+        if hits:
+            violations.append({
+                "index": index,
+                "route_id": delivery.route_id,
+                "zona": delivery.zona,
+                "plate": plate,
+                "vehicle_class": vehicle_class,
+                "start": delivery.start,
+                "end": delivery.end,
+                "restrictions": [restriction_summary(r) for r in {r["id"]: r for r in hits}.values()]
+            })
+    
+    return {
+        "hub_id": hub_id,
+        "date": plan.date,
+        "checked": len(plan.deliveries),
+        "valid": not violations and not errors,
+        "violations": violations,
+        "errors": errors
+    }
+
 @api_router.post("/hubs/{hub_id}/time-restrictions", response_model=TimeRestrictionResponse)
 async def create_time_restriction(hub_id: str, restriction_data: TimeRestrictionCreate, current_user: dict = Depends(get_current_user)):
     hub = await db.hubs.find_one({"id": hub_id})
@@ -1915,17 +4188,20 @@ async def create_time_restriction(hub_id: str, restriction_data: TimeRestriction
     if restriction_data.aplica_a not in RESTRICTION_APPLIES_TO:
         raise HTTPException(status_code=400, detail=f"aplica_a debe ser uno de: {RESTRICTION_APPLIES_TO}")
     
+    dias = restriction_data.dias or "L-V"
     restriction = {
         "id": str(uuid.uuid4()),
         "hub_id": hub_id,
         "zona": restriction_data.zona,
         "horario": restriction_data.horario,
-        "dias": restriction_data.dias or "L-V",
+        "dias": dias,
         "aplica_a": restriction_data.aplica_a,
         "notas": restriction_data.notas or "",
+        **parse_restriction_schedule(restriction_data.horario, dias),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.time_restrictions.insert_one(restriction)
+    invalidate_restriction_table(hub_id)
     
     return TimeRestrictionResponse(
         id=restriction["id"],
@@ -1948,12 +4224,24 @@ async def update_time_restriction(hub_id: str, restriction_id: str, restriction_
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
     
+    if "horario" in update_data or "dias" in update_data:
+        current = await db.time_restrictions.find_one(
+            {"id": restriction_id, "hub_id": hub_id}, {"_id": 0, "horario": 1, "dias": 1}
+        )
+        if not current:
+            raise HTTPException(status_code=404, detail="Restricción no encontrada")
+        update_data.update(parse_restriction_schedule(
+            update_data.get("horario", current["horario"]),
+            update_data.get("dias", current.get("dias", "L-V"))
+        ))
+    
     result = await db.time_restrictions.update_one(
         {"id": restriction_id, "hub_id": hub_id},
         {"$set": update_data}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Restricción no encontrada")
+    invalidate_restriction_table(hub_id)
     
     restriction = await db.time_restrictions.find_one({"id": restriction_id}, {"_id": 0})
     return TimeRestrictionResponse(
@@ -1972,6 +4260,7 @@ async def delete_time_restriction(hub_id: str, restriction_id: str, current_user
     result = await db.time_restrictions.delete_one({"id": restriction_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Restricción no encontrada")
+    invalidate_restriction_table(hub_id)
     return {"message": "Restricción eliminada correctamente"}
 
 # ==================== CATEGORIES ====================
@@ -1989,9 +4278,14 @@ CATEGORIES = [
     {"name": "Restricciones Horarias", "icon": "Clock", "route": "restricciones-horarias"}
 ]
 
+CATEGORIES_ETAG = static_etag(CATEGORIES)
+
 @api_router.get("/categories")
-async def get_categories(current_user: dict = Depends(get_current_user)):
-    return CATEGORIES
+async def get_categories(request: Request, current_user: dict = Depends(get_current_user)):
+    cache_control = f"private, max-age={STATIC_CACHE_SECONDS}"
+    if etag_matches(request, CATEGORIES_ETAG):
+        return not_modified(CATEGORIES_ETAG, cache_control)
+    return cacheable(CATEGORIES, CATEGORIES_ETAG, cache_control)
 
 # ==================== GENERIC RECORDS (for other categories) ====================
 
@@ -2011,14 +4305,19 @@ class RecordUpdate(BaseModel):
 async def get_hub_records(
     hub_id: str,
     category: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    total: bool = False,
+    since: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {"hub_id": hub_id}
     if category:
         query["category"] = category
     
-    records = await db.records.find(query, {"_id": 0}).to_list(1000)
-    return records
+    if since is not None:
+        return await changes_since(db.records, query, since, dict, {"_id": 0}, limit is not None or cursor is not None)
+    return await paginate(db.records, query, CREATED_SORT, dict, limit, cursor, total)
 
 @api_router.post("/hubs/{hub_id}/records")
 async def create_hub_record(hub_id: str, record_data: RecordCreate, current_user: dict = Depends(get_current_user)):
@@ -2026,7 +4325,7 @@ async def create_hub_record(hub_id: str, record_data: RecordCreate, current_user
     if not hub:
         raise HTTPException(status_code=404, detail="Hub no encontrado")
     
-    now = datetime.now(timezone.utc).isoformat()
+    now = utc_timestamp()
     record = {
         "id": str(uuid.uuid4()),
         "hub_id": hub_id,
@@ -2045,7 +4344,7 @@ async def create_hub_record(hub_id: str, record_data: RecordCreate, current_user
 @api_router.put("/hubs/{hub_id}/records/{record_id}")
 async def update_hub_record(hub_id: str, record_id: str, record_data: RecordUpdate, current_user: dict = Depends(get_current_user)):
     update_data = {k: v for k, v in record_data.model_dump().items() if v is not None}
-    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data["updated_at"] = utc_timestamp()
     
     result = await db.records.update_one(
         {"id": record_id, "hub_id": hub_id},
@@ -2062,6 +4361,7 @@ async def delete_hub_record(hub_id: str, record_id: str, current_user: dict = De
     result = await db.records.delete_one({"id": record_id, "hub_id": hub_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Registro no encontrado")
+    await record_tombstones("records", hub_id, [record_id])
     return {"message": "Registro eliminado correctamente"}
 
 # ==================== STATS ====================
@@ -2083,6 +4383,172 @@ async def get_stats(current_user: dict = Depends(get_current_user)):
 # Include router
 app.include_router(api_router)
 
+# ==================== COMPRESSION ====================
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "application/xml", "image/svg+xml")
+
+compression_stats = {
+    "responses": 0,
+    "compressed": 0,
+    "streamed": 0,
+    "raw_bytes": 0,
+    "sent_bytes": 0,
+    "by_encoding": {}
+}
+
+def compression_metrics() -> dict:
+    raw, sent = compression_stats["raw_bytes"], compression_stats["sent_bytes"]
+    return {
+        **compression_stats,
+        "saved_bytes": raw - sent,
+        "ratio": round(sent / raw, 3) if raw else None,
+        "encodings": [e for e in ("br", "gzip") if e != "br" or brotli],
+        "min_size": COMPRESSION_MIN_SIZE
+    }
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Best of br/gzip allowed by an Accept-Encoding header (q=0 excludes)"""
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    offered = (["br"] if brotli else []) + ["gzip"]
+    candidates = [e for e in offered if weights.get(e, weights.get("*", 0)) > 0]
+    return max(candidates, key=lambda e: weights.get(e, weights.get("*", 0)), default=None)
+
+class StreamCompressor:
+    """Incremental gzip/brotli encoder; every chunk is flushed so streamed data is not held back"""
+    
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            # wbits 31: zlib stream with a gzip header and trailer
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+class CompressionMiddleware:
+    """Compress responses with the encoding negotiated from Accept-Encoding.
+    
+    Complete bodies under COMPRESSION_MIN_SIZE are sent as is; streamed bodies
+    (more_body) are compressed chunk by chunk.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = negotiate_encoding(request_headers.get("accept-encoding", ""))
+        
+        start_message = None
+        compressor = None
+        passthrough = False
+        
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                headers = MutableHeaders(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if message["status"] == 304:
+                    # Same Vary and validator as the 200 the client holds
+                    headers.add_vary_header("Accept-Encoding")
+                    etag = headers.get("etag")
+                    if etag and encoding and encoded_etag(etag, encoding) in request_headers.get("if-none-match", ""):
+                        headers["ETag"] = encoded_etag(etag, encoding)
+                    passthrough = True
+                else:
+                    compressible = "content-encoding" not in headers and content_type.startswith(COMPRESSIBLE_TYPES)
+                    if compressible:
+                        # Whether or not this body ends up compressed, another client's might be
+                        headers.add_vary_header("Accept-Encoding")
+                    passthrough = not compressible or not encoding or message["status"] == 204
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            headers = MutableHeaders(raw=start_message["headers"]) if start_message else None
+            
+            if start_message is not None and compressor is None and not more_body:
+                # Whole body in one message
+                compression_stats["responses"] += 1
+                compression_stats["raw_bytes"] += len(body)
+                if len(body) >= COMPRESSION_MIN_SIZE:
+                    body = compress_body(body, encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    if "etag" in headers:
+                        headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                    compression_stats["compressed"] += 1
+                    compression_stats["by_encoding"][encoding] = compression_stats["by_encoding"].get(encoding, 0) + 1
+                compression_stats["sent_bytes"] += len(body)
+                await send(start_message)
+                start_message = None
+                await send({"type": "http.response.body", "body": body})
+                return
+            
+            if start_message is not None:
+                # First chunk of a streamed body: size unknown, always compress
+                compressor = StreamCompressor(encoding)
+                del headers["Content-Length"]
+                headers["Content-Encoding"] = encoding
+                if "etag" in headers:
+                    headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                compression_stats["responses"] += 1
+                compression_stats["compressed"] += 1
+                compression_stats["streamed"] += 1
+                compression_stats["by_encoding"][encoding] = compression_stats["by_encoding"].get(encoding, 0) + 1
+                await send(start_message)
+                start_message = None
+            
+            compression_stats["raw_bytes"] += len(body)
+            chunk = compressor.compress(body) if body else b""
+            if not more_body:
+                chunk += compressor.finish()
+            compression_stats["sent_bytes"] += len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
+
+app.add_middleware(CompressionMiddleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -2101,4 +4567,9 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if _revocation_task:
+        _revocation_task.cancel()
+    if _resource_version_task:
+        _resource_version_task.cancel()
     client.close()
+    password_executor.shutdown(wait=False)
@@ -0,0 +1,83 @@
+"""
+Backend tests for negotiated response compression
+Tests: gzip above the size threshold, identity below it or when not accepted, metrics
+"""
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def auth_headers():
+    """Headers with admin auth token"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="module")
+def holidays_url(auth_headers):
+    """A response comfortably above the compression threshold"""
+    response = requests.get(f"{BASE_URL}/api/hubs", headers=auth_headers)
+    hub = next((h for h in response.json() if h["name"] == "Hub Puerta Toledo"), None)
+    assert hub is not None, "Hub Puerta Toledo not found"
+    return f"{BASE_URL}/api/hubs/{hub['id']}/holidays?year=2026"
+
+
+class TestCompression:
+    """Accept-Encoding negotiation"""
+
+    def test_gzip_when_accepted(self, auth_headers, holidays_url):
+        response = requests.get(holidays_url, headers={**auth_headers, "Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers.get("Content-Encoding") == "gzip"
+        assert "Accept-Encoding" in response.headers.get("Vary", "")
+        assert len(response.json()["holidays"]) > 0
+        print(f"✓ gzip response, {response.headers.get('Content-Length')} bytes on the wire")
+
+    def test_identity_when_not_accepted(self, auth_headers, holidays_url):
+        response = requests.get(holidays_url, headers={**auth_headers, "Accept-Encoding": "identity"})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert "Accept-Encoding" in response.headers.get("Vary", "")
+        print("✓ Uncompressed when the client does not accept gzip/br, still Vary: Accept-Encoding")
+
+    def test_etag_depends_on_encoding(self, auth_headers, holidays_url):
+        identity = requests.get(holidays_url, headers={**auth_headers, "Accept-Encoding": "identity"})
+        gzipped = requests.get(holidays_url, headers={**auth_headers, "Accept-Encoding": "gzip"})
+        assert identity.headers["ETag"] != gzipped.headers["ETag"]
+        assert gzipped.headers["ETag"].endswith('-gzip"')
+
+        response = requests.get(holidays_url, headers={
+            **auth_headers, "Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["ETag"]
+        })
+        assert response.status_code == 304
+        assert response.headers["ETag"] == gzipped.headers["ETag"]
+        print("✓ Encoded bodies carry their own ETag and still revalidate")
+
+    def test_small_response_not_compressed(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/auth/me", headers={**auth_headers, "Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        print("✓ Responses under the threshold are sent as is")
+
+    def test_metrics(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/admin/metrics", headers=auth_headers)
+        assert response.status_code == 200
+        compression = response.json()["compression"]
+        assert compression["compressed"] > 0
+        assert compression["sent_bytes"] <= compression["raw_bytes"]
+        print(f"✓ Compression saved {compression['saved_bytes']} bytes so far")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,83 @@
+"""
+Backend tests for conditional GET (ETag / If-None-Match)
+Tests: 304 on unchanged hub data, ETag change after writes, static list caching
+"""
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def auth_headers():
+    """Headers with admin auth token"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="module")
+def hub_id(auth_headers):
+    """Get Hub Puerta Toledo ID"""
+    response = requests.get(f"{BASE_URL}/api/hubs", headers=auth_headers)
+    hub = next((h for h in response.json() if h["name"] == "Hub Puerta Toledo"), None)
+    assert hub is not None, "Hub Puerta Toledo not found"
+    return hub["id"]
+
+
+class TestConditionalGet:
+    """ETags on hub-scoped reads"""
+
+    @pytest.mark.parametrize("path", ["", "/vehicles", "/routes", "/employees", "/holidays?year=2026"])
+    def test_unchanged_returns_304(self, auth_headers, hub_id, path):
+        url = f"{BASE_URL}/api/hubs/{hub_id}{path}"
+        response = requests.get(url, headers=auth_headers)
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag, "Missing ETag"
+
+        response = requests.get(url, headers={**auth_headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        print(f"✓ {path or '/'} revalidates with 304")
+
+    def test_write_changes_etag(self, auth_headers, hub_id):
+        url = f"{BASE_URL}/api/hubs/{hub_id}/routes"
+        etag = requests.get(url, headers=auth_headers).headers["ETag"]
+
+        response = requests.post(url, json={"hub_id": hub_id, "name": "TEST_ETAG"}, headers=auth_headers)
+        assert response.status_code == 200
+        route_id = response.json()["id"]
+        try:
+            response = requests.get(url, headers={**auth_headers, "If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["ETag"] != etag
+            assert any(r["id"] == route_id for r in response.json())
+        finally:
+            requests.delete(f"{url}/{route_id}", headers=auth_headers)
+        print("✓ Creating a route invalidates the routes ETag")
+
+    @pytest.mark.parametrize("path", ["/categories", "/vehicle-types"])
+    def test_static_lists_long_cache(self, auth_headers, path):
+        response = requests.get(f"{BASE_URL}/api{path}", headers=auth_headers)
+        assert response.status_code == 200
+        assert "max-age=" in response.headers.get("Cache-Control", "")
+
+        response = requests.get(
+            f"{BASE_URL}/api{path}",
+            headers={**auth_headers, "If-None-Match": response.headers["ETag"]}
+        )
+        assert response.status_code == 304
+        print(f"✓ {path} is cacheable")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,135 @@
+"""
+Backend tests for delta sync
+Tests: ?since=<watermark> on list endpoints returns changed rows, deleted ids and the next watermark
+"""
+import time
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def api_session():
+    """Create authenticated session"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {response.json()['access_token']}"
+    })
+    return session
+
+
+@pytest.fixture(scope="module")
+def hub_id(api_session):
+    """Get Hub Puerta Toledo ID"""
+    response = api_session.get(f"{BASE_URL}/api/hubs")
+    assert response.status_code == 200
+    hub = next((h for h in response.json() if h["name"] == "Hub Puerta Toledo"), None)
+    assert hub is not None, "Hub Puerta Toledo not found"
+    return hub["id"]
+
+
+@pytest.fixture(scope="module")
+def watermark(api_session, hub_id):
+    """Watermark taken before the test writes"""
+    yesterday = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - 86400))
+    response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params={"since": yesterday})
+    assert response.status_code == 200
+    return response.json()["watermark"]
+
+
+class TestDeltaSync:
+    """Changed rows and tombstones after a watermark"""
+
+    contact_id = None
+
+    def test_created_row_is_returned(self, api_session, hub_id, watermark):
+        response = api_session.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/contacts",
+            json={"hub_id": hub_id, "name": "TEST_delta_sync"}
+        )
+        assert response.status_code == 200
+        TestDeltaSync.contact_id = response.json()["id"]
+
+        response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params={"since": watermark})
+        assert response.status_code == 200
+        data = response.json()
+        assert set(data) == {"items", "deleted_ids", "watermark"}
+        assert TestDeltaSync.contact_id in [c["id"] for c in data["items"]]
+        print(f"✓ Delta returned {len(data['items'])} changed contacts")
+
+    def test_deleted_row_is_reported(self, api_session, hub_id, watermark):
+        response = api_session.delete(f"{BASE_URL}/api/hubs/{hub_id}/contacts/{TestDeltaSync.contact_id}")
+        assert response.status_code == 200
+
+        response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params={"since": watermark})
+        data = response.json()
+        assert TestDeltaSync.contact_id in data["deleted_ids"]
+        print("✓ Deleted contact listed in deleted_ids")
+
+    def test_month_endpoint_accepts_since(self, api_session, hub_id, watermark):
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations",
+            params={"year": 2031, "month": 3, "since": watermark}
+        )
+        assert response.status_code == 200
+        assert "watermark" in response.json()
+        print("✓ Liquidations delta returned")
+
+    def test_incident_moved_out_of_range(self, api_session, hub_id, watermark):
+        response = api_session.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/vehicles",
+            json={"hub_id": hub_id, "plate": "TESTSYNC01", "vehicle_type": "Furgoneta"}
+        )
+        assert response.status_code == 200
+        vehicle_id = response.json()["id"]
+        try:
+            response = api_session.post(
+                f"{BASE_URL}/api/hubs/{hub_id}/incidents",
+                json={"vehicle_id": vehicle_id, "hub_id": hub_id, "title": "TEST_delta_sync", "date": "2031-03-10"}
+            )
+            incident_id = response.json()["id"]
+            api_session.put(f"{BASE_URL}/api/hubs/{hub_id}/incidents/{incident_id}", json={"date": "2031-05-10"})
+
+            response = api_session.get(
+                f"{BASE_URL}/api/hubs/{hub_id}/incidents",
+                params={"date_from": "2031-03-01", "date_to": "2031-03-31", "since": watermark}
+            )
+            assert response.status_code == 200
+            assert incident_id in [i["id"] for i in response.json()["items"]]
+            print("✓ Incident moved out of the date range still reaches the client")
+        finally:
+            api_session.delete(f"{BASE_URL}/api/hubs/{hub_id}/vehicles/{vehicle_id}")
+
+    def test_invalid_since(self, api_session, hub_id):
+        response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params={"since": "ayer"})
+        assert response.status_code == 400
+        print("✓ Unparseable since returns 400")
+
+    def test_expired_since(self, api_session, hub_id):
+        response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params={"since": "2000-01-01T00:00:00Z"})
+        assert response.status_code == 410
+        print("✓ since older than the tombstone retention returns 410")
+
+    def test_since_rejects_pagination(self, api_session, hub_id, watermark):
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/contacts",
+            params={"since": watermark, "limit": 10}
+        )
+        assert response.status_code == 400
+        print("✓ since with limit returns 400")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -259,6 +259,81 @@ class TestHolidaysAPI:
         
         print("✓ Custom holiday successfully removed from list")
 
+    def test_holidays_other_year(self, auth_headers, hub_id):
+        """Presets are computed for any year, including Easter-based dates"""
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/holidays",
+            params={"year": 2027},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        holiday_dates = [h["date"] for h in response.json()["holidays"]]
+        assert "2027-01-01" in holiday_dates, "Año Nuevo missing"
+        assert "2027-03-25" in holiday_dates, "Jueves Santo missing"
+        assert "2027-03-26" in holiday_dates, "Viernes Santo missing"
+        print("✓ 2027 holidays include Easter-relative dates")
+
+
+class TestWorkingCalendarAPI:
+    """Tests for the working-day calendar"""
+    
+    @pytest.fixture(scope="class")
+    def auth_headers(self):
+        response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": TEST_EMAIL,
+            "password": TEST_PASSWORD
+        })
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    @pytest.fixture(scope="class")
+    def hub_id(self, auth_headers):
+        """Get Hub Puerta Toledo ID"""
+        response = requests.get(f"{BASE_URL}/api/hubs", headers=auth_headers)
+        hub = next((h for h in response.json() if "toledo" in h["name"].lower()), None)
+        return hub["id"]
+    
+    def test_month_excludes_weekends_and_holidays(self, auth_headers, hub_id):
+        """April 2026: 22 weekdays minus Jueves and Viernes Santo"""
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/working-calendar",
+            params={"year": 2026, "month": 4},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        month = response.json()["months"][0]
+        assert month["working_days"] == 20
+        assert "2026-04-02" not in month["working_dates"]
+        assert len(month["weekend_dates"]) == 8
+        print(f"✓ April 2026 has {month['working_days']} working days")
+    
+    def test_attendance_summary_expected_days(self, auth_headers, hub_id):
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/attendance/summary",
+            params={"year": 2026, "month": 4},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["expected_days"] == 20
+        for emp in data["summary"]:
+            assert emp["expected_days"] == 20
+            assert "holidays_worked" in emp
+        print("✓ Attendance summary includes expected days")
+    
+    def test_overview_all_hubs(self, auth_headers):
+        response = requests.get(
+            f"{BASE_URL}/api/working-calendar",
+            params={"year": 2026},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        hubs = response.json()["hubs"]
+        assert len(hubs) > 0
+        for hub in hubs:
+            assert len(hub["by_month"]) == 12
+            assert hub["working_days"] == sum(hub["by_month"])
+        print(f"✓ Overview covers {len(hubs)} hubs")
+
 
 class TestTimeRestrictionsAPI:
     """Tests for Restricciones Horarias (Time Restrictions) endpoints"""
@@ -409,6 +484,87 @@ class TestTimeRestrictionsAPI:
         
         print("✓ Update persisted correctly")
     
+    def test_create_restriction_rejects_unparseable_schedule(self, auth_headers, hub_id):
+        """Horario and dias must be parseable into intervals and weekdays"""
+        for horario, dias in [("por las mañanas", "L-V"), ("8:00 - 20:00", "laborables")]:
+            response = requests.post(
+                f"{BASE_URL}/api/hubs/{hub_id}/time-restrictions",
+                json={
+                    "hub_id": hub_id,
+                    "zona": "TEST_Unparseable",
+                    "horario": horario,
+                    "dias": dias,
+                    "aplica_a": "todos"
+                },
+                headers=auth_headers
+            )
+            assert response.status_code == 400, f"Expected 400 for {horario!r}/{dias!r}, got {response.status_code}"
+        print("✓ Unparseable schedules correctly rejected")
+    
+    def test_check_restricted_zone(self, auth_headers, hub_id):
+        """The updated restriction (9:00 - 21:00, L-D, todos) blocks the zone at 10:00 but not at 22:00"""
+        if not created_restrictions:
+            pytest.skip("No restriction to check")
+        
+        params = {"vehicle_class": "vehiculos_0", "zona": "TEST_Centro Histórico", "at": "2031-03-17T10:00"}
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/time-restrictions/check",
+            params=params,
+            headers=auth_headers
+        )
+        assert response.status_code == 200, f"Check failed: {response.text}"
+        data = response.json()
+        assert data["allowed"] is False
+        assert any(r["id"] == created_restrictions[0] for r in data["restricted_zones"])
+        
+        params["at"] = "2031-03-17T22:00"
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/time-restrictions/check",
+            params=params,
+            headers=auth_headers
+        )
+        assert response.json()["allowed"] is True
+        print("✓ Check endpoint evaluates the parsed schedule")
+    
+    def test_validate_schedule_batch(self, auth_headers, hub_id):
+        """A whole day of deliveries is validated in one call"""
+        if not created_restrictions:
+            pytest.skip("No restriction to validate against")
+        
+        plan = {
+            "date": "2031-03-17",
+            "deliveries": [
+                {"zona": "TEST_Centro Histórico", "plate": "TEST0000", "start": "08:30", "end": "09:15", "vehicle_class": "vehiculos_0"},
+                {"zona": "TEST_Centro Histórico", "plate": "TEST0000", "start": "21:00", "end": "22:00", "vehicle_class": "vehiculos_0"},
+                {"zona": "TEST_Otra Zona", "plate": "TEST0000", "start": "10:00", "end": "11:00", "vehicle_class": "vehiculos_0"},
+                {"zona": "TEST_Centro Histórico", "plate": "TEST_NO_EXISTE", "start": "10:00", "end": "11:00"},
+                {"zona": "TEST_Centro Histórico", "plate": "TEST0000", "start": "25:00", "end": "26:00", "vehicle_class": "vehiculos_0"},
+                {"zona": "TEST_Centro Histórico", "plate": "TEST0000", "start": "08:30", "end": "08:30", "vehicle_class": "vehiculos_0"}
+            ]
+        }
+        response = requests.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/time-restrictions/validate",
+            json=plan,
+            headers=auth_headers
+        )
+        assert response.status_code == 200, f"Validate failed: {response.text}"
+        data = response.json()
+        
+        assert data["checked"] == 6
+        assert data["valid"] is False
+        assert [v["index"] for v in data["violations"]] == [0]
+        assert sorted(e["index"] for e in data["errors"]) == [3, 4, 5]
+        print(f"✓ Batch validation: {len(data['violations'])} violations, {len(data['errors'])} errors")
+    
+    def test_check_invalid_vehicle_class(self, auth_headers, hub_id):
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/time-restrictions/check",
+            params={"vehicle_class": "todos"},
+            headers=auth_headers
+        )
+        assert response.status_code == 400
+        print("✓ Invalid vehicle class correctly rejected")
+    
     def test_delete_time_restriction(self, auth_headers, hub_id):
         """Test deleting a time restriction"""
         global created_restrictions
@@ -0,0 +1,63 @@
+"""
+Backend tests for the index bootstrapper and explain-plan audit
+Tests: GET /admin/indexes/audit, POST /admin/indexes/rebuild, POST /admin/indexes/dedupe
+"""
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def auth_headers():
+    """Headers with admin auth token"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+class TestIndexAudit:
+    """Explain-plan audit for the endpoint queries"""
+
+    def test_audit_requires_auth(self):
+        response = requests.get(f"{BASE_URL}/api/admin/indexes/audit")
+        assert response.status_code in [401, 403]
+        print("✓ Audit requires authentication")
+
+    def test_dedupe_requires_auth(self):
+        response = requests.post(f"{BASE_URL}/api/admin/indexes/dedupe")
+        assert response.status_code in [401, 403]
+        print("✓ Dedupe requires authentication")
+
+    def test_audit_structure(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/admin/indexes/audit", headers=auth_headers)
+        assert response.status_code == 200
+
+        data = response.json()
+        assert "build" in data
+        assert "collscans" in data
+        assert "queries" in data
+        assert len(data["queries"]) > 0
+
+        for q in data["queries"]:
+            assert "endpoint" in q
+            assert "collection" in q
+        print(f"✓ Audit returned {len(data['queries'])} queries")
+
+    def test_no_collscans_after_build(self, auth_headers):
+        response = requests.get(f"{BASE_URL}/api/admin/indexes/audit", headers=auth_headers)
+        data = response.json()
+        if data["build"]["state"] != "done":
+            pytest.skip("Index build still running")
+
+        assert data["build"]["errors"] == [], f"Index errors: {data['build']['errors']}"
+        assert data["collscans"] == [], f"Queries doing COLLSCAN: {data['collscans']}"
+        print("✓ No endpoint query uses a collection scan")
@@ -361,6 +361,49 @@ class TestKilosLitrosBulk:
         assert data["count"] == 2
         print(f"✓ Bulk created {data['count']} entries")
     
+    def test_bulk_per_row_outcomes(self, api_session, hub_id, route_id):
+        """Test bulk save reports an outcome for every row"""
+        now = datetime.now()
+        date_str = now.strftime("%Y-%m-%d")
+        
+        entries = [
+            {
+                "hub_id": hub_id,
+                "route_id": route_id,
+                "date": date_str,
+                "repartidor": "TEST_bulk1",
+                "clientes": 11,
+                "kilos": 55.0,
+                "litros": 22.0,
+                "bultos": 6
+            },
+            {
+                "hub_id": hub_id,
+                "route_id": "invalid-route-id",
+                "date": date_str,
+                "repartidor": "test_bulk3"
+            },
+            {
+                "hub_id": hub_id,
+                "route_id": route_id,
+                "date": "not-a-date",
+                "repartidor": "test_bulk4"
+            }
+        ]
+        
+        response = api_session.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/kilos-litros/bulk",
+            json=entries
+        )
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["count"] == 1
+        statuses = [r["status"] for r in data["results"]]
+        assert statuses == ["updated", "error", "error"]
+        assert data["results"][1]["error"] == "Ruta no encontrada"
+        print(f"✓ Bulk outcomes: {statuses}")
+    
     def test_cleanup_bulk_entries(self, api_session, hub_id):
         """Clean up bulk test entries"""
         now = datetime.now()
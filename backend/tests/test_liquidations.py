@@ -0,0 +1,211 @@
+"""
+Backend API Tests for Liquidaciones
+Tests: bulk upsert with per-entry errors, monthly summary, repartidor ledger
+"""
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+# Far-off date so the test rows do not mix with real data
+TEST_DATE = "2031-03-15"
+TEST_REPARTIDOR = "test_ledger"
+
+
+@pytest.fixture(scope="module")
+def api_session():
+    """Create authenticated session"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    session = requests.Session()
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {response.json()['access_token']}"
+    })
+    return session
+
+
+@pytest.fixture(scope="module")
+def hub_id(api_session):
+    """Get Hub Puerta Toledo ID"""
+    response = api_session.get(f"{BASE_URL}/api/hubs")
+    assert response.status_code == 200
+    hub = next((h for h in response.json() if h["name"] == "Hub Puerta Toledo"), None)
+    assert hub is not None, "Hub Puerta Toledo not found"
+    return hub["id"]
+
+
+@pytest.fixture(scope="module")
+def route_id(api_session, hub_id):
+    """Get first available route ID"""
+    response = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/routes")
+    assert response.status_code == 200
+    routes = response.json()
+    assert len(routes) > 0, "No routes found for hub"
+    return routes[0]["id"]
+
+
+def bulk_entry(hub_id, route_id, **overrides):
+    entry = {
+        "hub_id": hub_id,
+        "route_id": route_id,
+        "date": TEST_DATE,
+        "repartidor": TEST_REPARTIDOR,
+        "metalico": 0,
+        "ingreso": 0,
+        "comentario": ""
+    }
+    entry.update(overrides)
+    return entry
+
+
+class TestLiquidationsBulk:
+    """Bulk upsert of liquidation entries"""
+
+    def test_bulk_reports_per_entry_errors(self, api_session, hub_id, route_id):
+        entries = [
+            bulk_entry(hub_id, route_id, metalico=100.0, ingreso=80.0),
+            bulk_entry(hub_id, "invalid-route-id"),
+            bulk_entry(hub_id, route_id, date="15/03/2031"),
+            {"hub_id": hub_id, "date": TEST_DATE}
+        ]
+        response = api_session.post(f"{BASE_URL}/api/hubs/{hub_id}/liquidations/bulk", json=entries)
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["count"] == 1
+        error_indexes = sorted({e["index"] for e in data["errors"]})
+        assert error_indexes == [1, 2, 3]
+        print(f"✓ Bulk saved {data['count']} entry, {len(data['errors'])} errors")
+
+    def test_bulk_upsert_keeps_single_row(self, api_session, hub_id, route_id):
+        response = api_session.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations/bulk",
+            json=[bulk_entry(hub_id, route_id, metalico=100.0, ingreso=80.0)]
+        )
+        assert response.status_code == 200
+
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations",
+            params={"year": 2031, "month": 3, "route_id": route_id}
+        )
+        rows = [e for e in response.json() if e["date"] == TEST_DATE]
+        assert len(rows) == 1
+        assert rows[0]["diferencia"] == 20.0
+        print("✓ Re-saving the same (route, date) updates the existing row")
+
+
+class TestLiquidationsColumnar:
+    """format=columnar month encoding"""
+
+    def test_columnar_matches_rows(self, api_session, hub_id):
+        params = {"year": 2031, "month": 3}
+        rows = api_session.get(f"{BASE_URL}/api/hubs/{hub_id}/liquidations", params=params).json()
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations",
+            params={**params, "format": "columnar"}
+        )
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["format"] == "columnar"
+        assert data["count"] == len(rows)
+        columns = data["columns"]
+        routes = data["dictionaries"]["route_id"]
+        decoded = {
+            columns["id"][i]: (routes[columns["route_id"][i]], f"2031-03-{columns['day'][i]:02d}", columns["diferencia"][i])
+            for i in range(data["count"])
+        }
+        assert decoded == {r["id"]: (r["route_id"], r["date"], r["diferencia"]) for r in rows}
+        print(f"✓ Columnar response decodes to the same {data['count']} rows")
+
+    def test_columnar_rejects_pagination(self, api_session, hub_id):
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations",
+            params={"year": 2031, "month": 3, "format": "columnar", "limit": 10}
+        )
+        assert response.status_code == 400
+        print("✓ Columnar with limit returns 400")
+
+
+class TestLiquidationsSummary:
+    """Monthly summary"""
+
+    def test_summary_contains_test_repartidor(self, api_session, hub_id, route_id):
+        response = api_session.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations/summary",
+            params={"year": 2031, "month": 3}
+        )
+        assert response.status_code == 200
+
+        data = response.json()
+        rep = next((r for r in data["by_repartidor"] if r["repartidor"] == TEST_REPARTIDOR), None)
+        assert rep is not None
+        assert rep["total"] == 20.0
+        assert rep["estado"] == "debe depositar 20.00 €"
+
+        route = next(r for r in data["by_route"] if r["route_id"] == route_id)
+        assert any(d["date"] == TEST_DATE for d in route["descuadres_detectados"])
+        print(f"✓ Summary: {rep['estado']}")
+
+
+class TestLiquidationLedger:
+    """Running balance per repartidor"""
+
+    def test_balance_as_of(self, api_session):
+        response = api_session.get(
+            f"{BASE_URL}/api/liquidations/ledger/balances",
+            params={"as_of": "2031-03-14"}
+        )
+        assert response.status_code == 200
+        before = {b["repartidor"]: b["balance"] for b in response.json()["balances"]}
+
+        response = api_session.get(
+            f"{BASE_URL}/api/liquidations/ledger/balances",
+            params={"as_of": TEST_DATE}
+        )
+        after = {b["repartidor"]: b["balance"] for b in response.json()["balances"]}
+
+        assert after[TEST_REPARTIDOR] - before.get(TEST_REPARTIDOR, 0) == 20.0
+        print("✓ Point-in-time balance includes the day's difference")
+
+    def test_statement(self, api_session):
+        response = api_session.get(
+            f"{BASE_URL}/api/liquidations/ledger/{TEST_REPARTIDOR}/statement",
+            params={"date_from": "2031-03-01", "date_to": "2031-03-31"}
+        )
+        assert response.status_code == 200
+
+        data = response.json()
+        assert any(m["date"] == TEST_DATE and m["amount"] == 20.0 for m in data["movements"])
+        assert data["closing_balance"] - data["opening_balance"] == 20.0
+        print(f"✓ Statement with {len(data['movements'])} movements")
+
+    def test_invalid_statement_range(self, api_session):
+        response = api_session.get(
+            f"{BASE_URL}/api/liquidations/ledger/{TEST_REPARTIDOR}/statement",
+            params={"date_from": "2031-04-01", "date_to": "2031-03-01"}
+        )
+        assert response.status_code == 400
+        print("✓ Inverted range returns 400")
+
+    def test_cleanup(self, api_session, hub_id, route_id):
+        """Zero the test entry so it does not weigh on the ledger"""
+        response = api_session.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/liquidations/bulk",
+            json=[bulk_entry(hub_id, route_id, repartidor="")]
+        )
+        assert response.status_code == 200
+        print("✓ Test entry zeroed")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,162 @@
+"""
+Backend tests for keyset pagination on list endpoints
+Tests: limit/cursor/next_cursor, opt-in total, legacy full-list responses, null sort values
+"""
+import uuid
+import pytest
+import requests
+import os
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+ADMIN_EMAIL = "admin@admin.com"
+ADMIN_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def auth_headers():
+    """Headers with admin auth token"""
+    response = requests.post(
+        f"{BASE_URL}/api/auth/login",
+        json={"email": ADMIN_EMAIL, "password": ADMIN_PASSWORD}
+    )
+    assert response.status_code == 200, f"Login failed: {response.text}"
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="module")
+def hub_id(auth_headers):
+    """Get Hub Puerta Toledo ID"""
+    response = requests.get(f"{BASE_URL}/api/hubs", headers=auth_headers)
+    hub = next((h for h in response.json() if h["name"] == "Hub Puerta Toledo"), None)
+    assert hub is not None, "Hub Puerta Toledo not found"
+    return hub["id"]
+
+
+@pytest.fixture(scope="module")
+def test_contacts(auth_headers, hub_id):
+    """Create a few contacts so there is more than one page"""
+    created = []
+    for i in range(3):
+        response = requests.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/contacts",
+            json={"hub_id": hub_id, "name": f"TEST_Paginacion {i}", "position": "", "phone": ""},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        created.append(response.json()["id"])
+    yield created
+    for contact_id in created:
+        requests.delete(f"{BASE_URL}/api/hubs/{hub_id}/contacts/{contact_id}", headers=auth_headers)
+
+
+class TestKeysetPagination:
+    """Cursor pagination over contacts"""
+
+    def test_without_limit_returns_full_list(self, auth_headers, hub_id, test_contacts):
+        response = requests.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", headers=auth_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data, list)
+        assert set(test_contacts) <= {c["id"] for c in data}
+        print(f"✓ Unpaginated request returns all {len(data)} contacts")
+
+    def test_walk_pages(self, auth_headers, hub_id, test_contacts):
+        full = requests.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", headers=auth_headers).json()
+
+        seen = []
+        params = {"limit": 2, "total": "true"}
+        while True:
+            response = requests.get(f"{BASE_URL}/api/hubs/{hub_id}/contacts", params=params, headers=auth_headers)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["items"]) <= 2
+            assert page["total"] == len(full)
+            seen.extend(c["id"] for c in page["items"])
+            if not page["next_cursor"]:
+                break
+            params = {"limit": 2, "cursor": page["next_cursor"], "total": "true"}
+
+        assert seen == [c["id"] for c in full]
+        print(f"✓ Walked {len(seen)} contacts in pages of 2, same order as the full list")
+
+    def test_invalid_cursor(self, auth_headers, hub_id):
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/contacts",
+            params={"limit": 2, "cursor": "not-a-cursor"},
+            headers=auth_headers
+        )
+        assert response.status_code == 400
+        print("✓ Invalid cursor returns 400")
+
+    def test_invalid_limit(self, auth_headers, hub_id):
+        response = requests.get(
+            f"{BASE_URL}/api/hubs/{hub_id}/incidents",
+            params={"limit": 0},
+            headers=auth_headers
+        )
+        assert response.status_code == 422
+        print("✓ limit=0 is rejected")
+
+
+@pytest.fixture(scope="module")
+def legacy_incidents(auth_headers, hub_id):
+    """A vehicle with dated incidents plus legacy rows whose date could not be parsed"""
+    if not os.environ.get("MONGO_URL") or not os.environ.get("DB_NAME"):
+        pytest.skip("MONGO_URL/DB_NAME needed to insert legacy incidents")
+    from pymongo import MongoClient
+
+    response = requests.post(
+        f"{BASE_URL}/api/hubs/{hub_id}/vehicles",
+        json={"hub_id": hub_id, "plate": "TESTPAG01", "vehicle_type": "Furgoneta"},
+        headers=auth_headers
+    )
+    assert response.status_code == 200, response.text
+    vehicle_id = response.json()["id"]
+    for day in ("2031-01-10", "2031-01-20"):
+        response = requests.post(
+            f"{BASE_URL}/api/hubs/{hub_id}/incidents",
+            json={"vehicle_id": vehicle_id, "hub_id": hub_id, "title": f"TEST_Paginacion {day}", "date": day},
+            headers=auth_headers
+        )
+        assert response.status_code == 200, response.text
+
+    client = MongoClient(os.environ["MONGO_URL"])
+    client[os.environ["DB_NAME"]].incidents.insert_many([{
+        "id": str(uuid.uuid4()),
+        "vehicle_id": vehicle_id,
+        "hub_id": hub_id,
+        "title": f"TEST_Paginacion sin fecha {i}",
+        "date": "sin fecha",
+        "date_iso": None,
+        "created_at": "2031-01-01T00:00:00+00:00"
+    } for i in range(2)])
+    client.close()
+    yield vehicle_id
+    requests.delete(f"{BASE_URL}/api/hubs/{hub_id}/vehicles/{vehicle_id}", headers=auth_headers)
+
+
+class TestNullSortKeys:
+    """Rows with a null sort value are paginated like the full list"""
+
+    def test_incidents_with_null_date(self, auth_headers, hub_id, legacy_incidents):
+        url = f"{BASE_URL}/api/hubs/{hub_id}/incidents"
+        full = requests.get(url, params={"vehicle_id": legacy_incidents}, headers=auth_headers).json()
+        assert len(full) == 4
+
+        seen = []
+        params = {"vehicle_id": legacy_incidents, "limit": 1}
+        while True:
+            page = requests.get(url, params=params, headers=auth_headers).json()
+            seen.extend(i["id"] for i in page["items"])
+            if not page["next_cursor"]:
+                break
+            params = {"vehicle_id": legacy_incidents, "limit": 1, "cursor": page["next_cursor"]}
+
+        assert seen == [i["id"] for i in full]
+        print("✓ Incidents without a parsed date are kept across pages")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])